@@ -1,16 +1,28 @@
-import os, logging
+import os, json, hashlib, logging
+from typing import Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone as dtz
-from flask import Flask, jsonify, request, session, redirect, url_for, render_template, send_from_directory
+from collections import Counter
+from itertools import chain
+from contextlib import ExitStack
+from flask import Flask, Response, g, jsonify, request, session, redirect, url_for, render_template, send_from_directory
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_talisman import Talisman
 from itsdangerous import URLSafeSerializer
 import requests
+from google.auth.exceptions import RefreshError
 
-from storage import Storage
-from ranking import rank_messages
+from storage import get_storage, DEFAULT_PREFS
+from ranking import rank_messages, rank_messages_for_users
 from auth_google import exchange_code_for_id
-from gmail_client import fetch_recent_messages, build_gmail_service
-from mailer import email_digest
+from gmail_client import iter_recent_messages, sync_recent_messages, build_gmail_service, get_service_manager, service_stats, SCOPES
+from tokens import token_encryption_enabled
+from mailer import email_digest, SEND_WORKERS
+from snapshot import SnapshotCache
+from grouping import group_messages
+from render import render_cache, stream_digest, digest_hash, THEMES, RENDER_STREAM_ROWS
+from jobs import JobQueue, job_view
+import metrics
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret-change-me")
@@ -19,6 +31,21 @@ Talisman(app, force_https=True, strict_transport_security=True)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
 
+# Keep the digest window and Gmail historyId in Storage and only fetch what changed between runs.
+INCREMENTAL_SYNC = os.getenv("GMAIL_INCREMENTAL_SYNC", "1") == "1"
+# Page loads serve the scheduled run's latest digest until it is this old (or ?fresh=1).
+LATEST_MAX_AGE_HOURS = float(os.getenv("LATEST_DIGEST_MAX_AGE_HOURS", "12"))
+# Mailboxes fetched at once by the scheduled run; each is also paced by its own Gmail quota.
+MAILBOX_WORKERS = int(os.getenv("MAILBOX_WORKERS", "16"))
+# Longest window /api/digest?days= will fetch; larger requests are clamped to it.
+MAX_DIGEST_DAYS = int(os.getenv("MAX_DIGEST_DAYS", "30"))
+
+# Provision Cosmos once per worker at startup instead of on the first request.
+try:
+    get_storage()
+except Exception as e:
+    logger.warning("Storage not available at startup: %s", e)
+
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
@@ -32,10 +59,49 @@ class User(UserMixin):
 def load_user(user_id):
     email = session.get("email")
     if not email: return None
-    st = Storage()
+    st = get_storage()
     is_admin = st.is_admin(email)
     return User(user_id, email, is_admin)
 
+snapshots = SnapshotCache()
+
+def mailbox_for(st, email: Optional[str]):
+    """(mailbox key, service builder) for `email`'s own Gmail if they granted
+    access at login, else the shared GMAIL_REFRESH_TOKEN mailbox ("me")."""
+    token = st.get_gmail_token(email) if email else None
+    if token is None: return "me", build_gmail_service
+    return email, get_service_manager(token).service
+
+def load_messages(st, days: int = 1, email: Optional[str] = None):
+    """Messages from the last `days` in `email`'s mailbox, threads and
+    near-duplicates already collapsed, served from the shared snapshot so the
+    digest and preview endpoints don't each rescan it."""
+    return fetch_mailbox(st, *mailbox_for(st, email), days=days)
+
+def fetch_mailbox(st, mailbox: str, build_service, days: int = 1):
+    """The grouped window for `mailbox` (see load_messages). If a user's own
+    grant has been revoked, their stored token is deleted and the shared
+    mailbox is used from then on, instead of failing every request."""
+    try:
+        return _fetch_mailbox(st, mailbox, build_service, days)
+    except RefreshError as e:
+        if mailbox == "me" or getattr(e, "retryable", False): raise
+        logger.warning("Gmail grant for %s was revoked (%s); deleting the token and using the shared mailbox", mailbox, e)
+        st.delete_gmail_token(mailbox)
+        return _fetch_mailbox(st, "me", build_gmail_service, days)
+
+def _fetch_mailbox(st, mailbox: str, build_service, days: int):
+    since = datetime.now(dtz.utc) - timedelta(days=days)
+    def fetch(gmail):
+        with metrics.timed("gmail.fetch"):
+            if INCREMENTAL_SYNC:
+                msgs = sync_recent_messages(gmail, since, st, mailbox=mailbox)
+            else:
+                msgs = list(iter_recent_messages(gmail, since))
+        # Grouped once per snapshot, so every ranking of it sees the collapsed view.
+        return group_messages(msgs, mailbox)
+    return snapshots.get((mailbox, days), build_service, fetch, since=since.timestamp())
+
 # ---------- Auth ----------
 @app.route("/login")
 def login():
@@ -46,7 +112,7 @@ def login():
         "client_id": client_id,
         "redirect_uri": redirect_uri,
         "response_type": "code",
-        "scope": "openid email profile",
+        "scope": " ".join(["openid", "email", "profile"] + SCOPES),
         "access_type": "offline",
         "prompt": "consent",
         "state": state,
@@ -62,13 +128,18 @@ def oauth_callback():
     next_url = data.get("next", "/")
     userinfo = exchange_code_for_id(code, url_for("oauth_callback", _external=True))
     email = (userinfo.get("email") or "").lower()
-    st = Storage()
+    st = get_storage()
     if not st.is_allowed(email):
         # bootstrap: if allowlist empty, add ADMIN_EMAIL and email if matches
         admin = (os.getenv("ADMIN_EMAIL","") or "").lower()
         st.bootstrap_admin(admin)
         if not st.is_allowed(email):
             return "Unauthorized", 403
+    if userinfo.get("refresh_token") and set(SCOPES) <= set(userinfo.get("scopes", [])):
+        if token_encryption_enabled():
+            st.save_gmail_token(email, userinfo["refresh_token"])
+        else:
+            logger.warning("TOKEN_ENCRYPTION_KEY not set; not storing the Gmail token for %s", email)
     user = User(uid=email, email=email, is_admin=st.is_admin(email))
     login_user(user); session["email"] = email
     return redirect(next_url)
@@ -87,30 +158,19 @@ def index():
 @app.route("/api/preview_email_html")
 @login_required
 def preview_email_html():
-    st = Storage()
+    st = get_storage()
     prefs = st.get_prefs(current_user.email)
-    gmail = build_gmail_service()
-    since = datetime.now(dtz.utc) - timedelta(days=1)
-    msgs = fetch_recent_messages(gmail, since)
-    ranked = rank_messages(msgs, prefs)
-    from mailer import format_html
-    theme = prefs.get("email_theme","light"); top_n = int(prefs.get("top_n",20))
-    min_score = float(prefs.get("min_score",0.0))
+    theme = prefs.get("email_theme","light")
+    latest = latest_digest(st, current_user.email, prefs)
+    if latest:
+        return conditional(latest_html(latest, theme, "email"), f"{latest['version']}-email-{theme}")
+    ranked = rank_messages(load_messages(st, email=current_user.email), prefs)
+    top_n = int(prefs.get("top_n",20)); min_score = float(prefs.get("min_score",0.0))
     filtered = [m for m in ranked if m.get("score",0) >= min_score][:top_n]
-    
-    # breakdown of reasons above threshold
-    from collections import Counter
-    reason_counts = Counter()
-    for m in filtered:
-        for r in m.get("reasons", []):
-            reason_counts[r] += 1
-    threshold_info = "<p style='color:gray;font-size:0.9em'>Importance threshold: %.2f — %d messages shown of %d. Top reasons: %s</p>" % (
-        min_score, len(filtered), len(ranked),
-        ", ".join(f"{k} ({v})" for k,v in reason_counts.most_common(5))
-    )
-    html = threshold_info + html
-    html = format_html(current_user.email, filtered, theme, top_n)
-    return html
+    if len(filtered) >= RENDER_STREAM_ROWS:
+        return Response(chain([threshold_info(filtered, min_score, len(ranked))], stream_digest(filtered, theme, top_n)), mimetype="text/html")
+    doc = materialize_latest(st, current_user.email, ranked, prefs)
+    return conditional(latest_html(doc, theme, "email"), f"{doc['version']}-email-{theme}")
 
 @app.route("/settings")
 @login_required
@@ -127,7 +187,7 @@ def admin_page():
 @app.route("/api/admin/users", methods=["GET","POST","DELETE"])
 @login_required
 def admin_users():
-    st = Storage()
+    st = get_storage()
     if not st.is_admin(current_user.email): return ("Forbidden", 403)
     if request.method == "GET":
         return jsonify(st.get_allowlist())
@@ -140,58 +200,277 @@ def admin_users():
     st.remove_allowed(data.get("email","").lower())
     return jsonify({"ok": True})
 
+@app.route("/api/admin/gmail_stats")
+@login_required
+def admin_gmail_stats():
+    if not current_user.is_admin: return ("Forbidden", 403)
+    return jsonify(service_stats())
+
+def metrics_allowed() -> bool:
+    """Admins, or scrapers presenting the configured X-API-Key."""
+    if os.getenv("X_API_KEY") and api_key_ok(): return True
+    return current_user.is_authenticated and current_user.is_admin
+
+@app.route("/api/admin/metrics")
+def admin_metrics():
+    if not metrics_allowed(): return ("Forbidden", 403)
+    gauges = [(f"gmail_{k}", {}, v) for k, v in service_stats().items()]
+    for cache, stats in (("user_records", get_storage().user_cache.stats()), ("gmail_tokens", get_storage().token_cache.stats()),
+                         ("rendered_digests", render_cache.stats())):
+        gauges += [(f"cache_{k}", {"cache": cache}, v) for k, v in stats.items()]
+    return Response(metrics.registry.render(gauges), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_profile():
+    # ?profile=1 dumps a cProfile of this request to PROFILE_DIR (opt-in, admins/API key only).
+    if metrics.PROFILE_DIR and request.args.get("profile") == "1" and metrics_allowed():
+        g.profile = ExitStack()
+        g.profile_path = g.profile.enter_context(metrics.profiled(request.endpoint or "request"))
+
+@app.after_request
+def stop_profile(response):
+    stack = g.pop("profile", None)
+    if stack is not None:
+        stack.close()
+        response.headers["X-Profile-Dump"] = g.profile_path
+    return response
+
+@app.route("/api/admin/cache_stats")
+@login_required
+def admin_cache_stats():
+    if not current_user.is_admin: return ("Forbidden", 403)
+    st = get_storage()
+    return jsonify({"user_records": st.user_cache.stats(), "gmail_tokens": st.token_cache.stats(), "rendered_digests": render_cache.stats()})
+
 # ---------- Preferences ----------
+def valid_delivery_hours(hours) -> bool:
+    return isinstance(hours, list) and all(type(h) is int and 0 <= h < 24 for h in hours)
+
 @app.route("/api/prefs", methods=["GET", "POST"])
 @login_required
 def prefs():
-    st = Storage()
+    st = get_storage()
     if request.method == "GET":
         return jsonify(st.get_prefs(current_user.email))
     data = request.get_json(force=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "prefs must be an object"}), 400
+    if "delivery_hours" in data and not valid_delivery_hours(data["delivery_hours"]):
+        return jsonify({"error": "delivery_hours must be a list of whole hours 0-23"}), 400
     st.save_prefs(current_user.email, data)
     return jsonify({"ok": True})
 
 # ---------- Digest ----------
+# ---------- Latest digest ----------
+def digest_version(ranked, prefs) -> str:
+    """Content version of a ranked digest under `prefs`; the ETag base."""
+    return digest_hash(ranked) + prefs_hash(prefs)
+
+def prefs_hash(prefs) -> str:
+    return hashlib.blake2b(json.dumps(prefs, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+def threshold_info(filtered, min_score, total) -> str:
+    """Breakdown of reasons above the threshold, shown above the email preview."""
+    reason_counts = Counter(r for m in filtered for r in m.get("reasons", []))
+    return "<p style='color:gray;font-size:0.9em'>Importance threshold: %.2f — %d messages shown of %d. Top reasons: %s</p>" % (
+        min_score, len(filtered), total,
+        ", ".join(f"{k} ({v})" for k,v in reason_counts.most_common(5))
+    )
+
+def render_views(email, ranked, prefs, theme) -> Dict[str, str]:
+    """The HTML served by /api/preview_digest ("preview") and
+    /api/preview_email_html ("email") for one theme."""
+    from mailer import format_html
+    top_n = int(prefs.get("top_n",20)); min_score = float(prefs.get("min_score",0.0))
+    filtered = [m for m in ranked if m.get("score",0) >= min_score][:top_n]
+    return {"preview": format_html(email, ranked, theme, top_n),
+            "email": threshold_info(filtered, min_score, len(ranked)) + format_html(email, filtered, theme, top_n)}
+
+def materialize_latest(st, email, ranked, prefs) -> Dict[str, Any]:
+    """Store `ranked` (the default one-day window) with its HTML in every theme
+    as `email`'s latest digest and return the document."""
+    doc = {"version": digest_version(ranked, prefs), "prefs_hash": prefs_hash(prefs), "ranked": ranked,
+           "html": {theme: render_views(email, ranked, prefs, theme) for theme in THEMES}}
+    st.save_latest(email, doc)
+    return doc
+
+def latest_digest(st, email, prefs) -> Optional[Dict[str, Any]]:
+    """The materialized latest digest, unless ?fresh=1 asks for a live run or it
+    is too old or was ranked under different prefs."""
+    if request.args.get("fresh") == "1": return None
+    doc = st.get_latest(email)
+    if doc is None or doc.get("prefs_hash") != prefs_hash(prefs): return None
+    if datetime.utcnow() - datetime.fromisoformat(doc["created_at"]) > timedelta(hours=LATEST_MAX_AGE_HOURS): return None
+    return doc
+
+def latest_html(doc, theme, view) -> str:
+    return (doc["html"].get(theme) or doc["html"]["light"])[view]
+
+def conditional(body, etag, mimetype="text/html"):
+    """`body` with a strong ETag; a matching If-None-Match gets a 304."""
+    resp = app.response_class(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
 @app.route("/api/digest")
 @login_required
 def api_digest():
-    days = int(request.args.get("days", 1))
-    since = datetime.now(dtz.utc) - timedelta(days=days)
-    gmail = build_gmail_service()
-    msgs = fetch_recent_messages(gmail, since)
-    st = Storage()
+    try:
+        days = max(1, min(MAX_DIGEST_DAYS, int(request.args.get("days", 1))))
+    except ValueError:
+        return jsonify({"error": "days must be an integer"}), 400
+    st = get_storage()
     prefs = st.get_prefs(current_user.email)
-    ranked = rank_messages(msgs, prefs)
+    latest = latest_digest(st, current_user.email, prefs) if days == 1 else None
+    if latest:
+        ranked, version = latest["ranked"], latest["version"]
+    else:
+        mailbox, build_service = mailbox_for(st, current_user.email)
+        ranked = rank_messages(fetch_mailbox(st, mailbox, build_service, days), prefs)
+        st.save_digest(current_user.email, ranked, mailbox)
+        version = materialize_latest(st, current_user.email, ranked, prefs)["version"] if days == 1 else digest_version(ranked, prefs)
     min_score = float(prefs.get('min_score', 0.0))
     ranked_filt = [m for m in ranked if (m.get('score',0) >= min_score)]
-    st.save_digest(current_user.email, ranked)
-    return jsonify({"messages": ranked_filt, "total": len(ranked), "shown": len(ranked_filt)})
+    body = json.dumps({"messages": ranked_filt, "total": len(ranked), "shown": len(ranked_filt)})
+    return conditional(body, f"{version}-{days}", mimetype="application/json")
 
-@app.route("/api/run_digest", methods=["POST"])
-def run_digest_webhook():
-    api_key = request.headers.get("X-API-Key", "")
-    if api_key != os.getenv("X_API_KEY", ""):
-        return "Forbidden", 403
-    gmail = build_gmail_service()
-    since = datetime.now(dtz.utc) - timedelta(days=1)
-    msgs = fetch_recent_messages(gmail, since)
-    st = Storage()
-    # run for all allowed users
+@app.route("/api/digests")
+@login_required
+def digest_history():
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    try:
+        digests, token = get_storage().get_digest_page(current_user.email, limit, request.args.get("continuation"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"digests": digests, "continuation": token})
+
+def deliver_digest(st, email, mailbox, ranked, prefs):
+    st.save_digest(email, ranked, mailbox)
+    materialize_latest(st, email, ranked, prefs)
+    email_digest(email, ranked, prefs)
+
+def shard_of(email: str, shards: int) -> int:
+    """Stable shard for `email` (Python's hash() is salted per process)."""
+    return int.from_bytes(hashlib.blake2b(email.lower().encode(), digest_size=8).digest(), "big") % shards
+
+def delivery_hours(email, prefs) -> set:
+    """Local hours `email` gets the scheduled digest at. Prefs saved before
+    validation may hold anything; those users get the default hours (logged)
+    instead of failing the whole shard."""
+    hours = prefs.get("delivery_hours", DEFAULT_PREFS["delivery_hours"])
+    if not valid_delivery_hours(hours):
+        logger.warning("Invalid delivery_hours %r for %s; using the defaults", hours, email)
+        hours = DEFAULT_PREFS["delivery_hours"]
+    return set(hours)
+
+@metrics.stage("pipeline.run_digest")
+def run_digest(st, params, progress):
+    """The scheduled pipeline: fetch, rank for every allowlisted user, save
+    (history plus the materialized latest digest) and email. Runs on the job queue's worker thread.
+
+    With {"shard": i, "of": n} only the users in shard i of n run, and with
+    {"hour": h} only those whose delivery_hours include local hour h."""
     recipients = st.get_allowlist()
-    sent = 0
+    shards = int(params.get("of") or 1)
+    if shards > 1:
+        recipients = [email for email in recipients if shard_of(email, shards) == int(params["shard"])]
+    prefs_by_user = {email: st.get_prefs(email) for email in recipients}
+    if params.get("hour") is not None:
+        recipients = [email for email in recipients if int(params["hour"]) in delivery_hours(email, prefs_by_user[email])]
+    users_by_mailbox, mailbox_of, builders, failed = {}, {}, {}, []
     for email in recipients:
-        prefs = st.get_prefs(email)
-        ranked = rank_messages(msgs, prefs)
-        st.save_digest(email, ranked)
-        # email out
         try:
-            email_digest(email, ranked, prefs)
-            sent += 1
+            mailbox, build_service = mailbox_for(st, email)
         except Exception as e:
-            logger.exception("SendGrid failed for %s: %s", email, e)
-    # retention cleanup
-    st.cleanup_retention(days=180)
-    return jsonify({"ok": True, "recipients": len(recipients), "emailed": sent})
+            # e.g. a throttled token read: only this user misses the run.
+            logger.exception("Could not resolve the mailbox for %s: %s", email, e)
+            failed.append({"email": email, "error": f"mailbox lookup failed: {e}"})
+            continue
+        users_by_mailbox.setdefault(mailbox, []).append(email); builders[mailbox] = build_service
+        mailbox_of[email] = mailbox
+    # Fetch every mailbox concurrently, MAILBOX_WORKERS at a time; each client
+    # paces itself against its own mailbox's Gmail quota.
+    ranked_by_user = {}
+    with ThreadPoolExecutor(max_workers=MAILBOX_WORKERS) as pool:
+        futures = {pool.submit(fetch_mailbox, st, mailbox, build): mailbox for mailbox, build in builders.items()}
+        for fut in as_completed(futures):
+            mailbox = futures[fut]; users = users_by_mailbox[mailbox]
+            try:
+                msgs = fut.result()
+            except Exception as e:
+                logger.exception("Mailbox fetch failed for %s: %s", mailbox, e)
+                failed += [{"email": email, "error": f"mailbox fetch failed: {e}"} for email in users]
+                continue
+            # Users sharing a mailbox are ranked together in one vectorized pass.
+            ranked_by_user.update(rank_messages_for_users(msgs, {email: prefs_by_user[email] for email in users}))
+            progress(recipients=len(recipients), mailboxes=len(builders), ranked=len(ranked_by_user), failed=len(failed))
+    # persist and email out concurrently; one slow send no longer holds up the rest
+    sent = 0
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS) as pool:
+        futures = {pool.submit(deliver_digest, st, email, mailbox_of[email], ranked, prefs_by_user[email]): email for email, ranked in ranked_by_user.items()}
+        for fut in as_completed(futures):
+            email = futures[fut]
+            try:
+                fut.result(); sent += 1
+            except Exception as e:
+                logger.exception("Digest delivery failed for %s: %s", email, e)
+                failed.append({"email": email, "error": str(e)})
+            progress(recipients=len(recipients), emailed=sent, failed=len(failed))
+    return {"recipients": len(recipients), "emailed": sent, "failed": failed,
+            **{k: params[k] for k in ("shard", "of", "hour") if k in params}}
+
+def run_retention(st, params, progress):
+    """Nightly maintenance: finish moving any digests still in the old shared
+    partition, then apply retention."""
+    migrated = st.migrate_digest_partitions(progress=progress)
+    return {"migrated": migrated, **st.cleanup_retention(progress=progress)}
+
+digest_jobs = JobQueue(run_digest, get_storage)
+retention_jobs = JobQueue(run_retention, get_storage)
+
+def api_key_ok() -> bool:
+    return request.headers.get("X-API-Key", "") == os.getenv("X_API_KEY", "")
+
+@app.route("/api/run_digest", methods=["POST"])
+def run_digest_webhook():
+    if not api_key_ok():
+        return "Forbidden", 403
+    # Retries of the same trigger carry the same run id (default: the current UTC hour) and are no-ops.
+    run_id = request.args.get("run_id") or request.headers.get("X-Run-Id") or datetime.utcnow().strftime("%Y%m%d%H")
+    params = {"profile": True} if request.args.get("profile") == "1" and metrics.PROFILE_DIR else {}
+    try:
+        shard, shards = int(request.args.get("shard", 0)), int(request.args.get("of", 1))
+        hour = int(request.args["hour"]) if "hour" in request.args else None
+    except ValueError:
+        return jsonify({"error": "shard, of and hour must be integers"}), 400
+    if not 0 <= shard < shards or (hour is not None and not 0 <= hour < 24):
+        return jsonify({"error": "need 0 <= shard < of and 0 <= hour < 24"}), 400
+    if shards > 1:
+        # One job per shard of the slot: a rerun only redoes shards that failed or stalled.
+        run_id = f"{run_id}:{shard}-of-{shards}"
+        params.update(shard=shard, of=shards)
+    if hour is not None: params["hour"] = hour
+    job = digest_jobs.submit(get_storage(), run_id, params)
+    return jsonify(job_view(job)), 202, {"Location": url_for("run_digest_status", run_id=run_id)}
+
+@app.route("/api/run_retention", methods=["POST"])
+def run_retention_webhook():
+    if not api_key_ok():
+        return "Forbidden", 403
+    run_id = "retention-" + datetime.utcnow().strftime("%Y%m%d")
+    job = retention_jobs.submit(get_storage(), run_id)
+    return jsonify(job_view(job)), 202, {"Location": url_for("run_digest_status", run_id=run_id)}
+
+@app.route("/api/run_digest/<run_id>")
+def run_digest_status(run_id):
+    if not api_key_ok():
+        return "Forbidden", 403
+    job = get_storage().get_job(run_id)
+    if job is None: return jsonify({"error": "not found"}), 404
+    return jsonify(job_view(job))
 
 @app.route("/static/dist/<path:path>")
 def serve_dist(path):
@@ -203,30 +482,37 @@ if __name__ == "__main__":
 @app.route("/api/preview_digest")
 @login_required
 def preview_digest():
-    gmail = build_gmail_service()
-    since = datetime.now(dtz.utc) - timedelta(days=1)
-    msgs = fetch_recent_messages(gmail, since)
-    st = Storage()
+    st = get_storage()
     prefs = st.get_prefs(current_user.email)
-    ranked = rank_messages(msgs, prefs)
-    from mailer import format_html
     theme = prefs.get('email_theme','light')
+    latest = latest_digest(st, current_user.email, prefs)
+    if latest:
+        return conditional(latest_html(latest, theme, "preview"), f"{latest['version']}-preview-{theme}")
+    from mailer import format_html
     top_n = int(prefs.get('top_n',20))
-    html = format_html(current_user.email, ranked, theme, top_n)
-    return html
+    ranked = rank_messages(load_messages(st, email=current_user.email), prefs, top_n=top_n)
+    if len(ranked) >= RENDER_STREAM_ROWS:
+        return Response(stream_digest(ranked, theme, top_n), mimetype="text/html")
+    return conditional(format_html(current_user.email, ranked, theme, top_n), f"{digest_version(ranked, prefs)}-preview-{theme}")
 
 @app.route("/api/admin/analytics")
 @login_required
 def admin_analytics():
     if current_user.email.lower() != os.getenv("ADMIN_EMAIL", "").lower():
         return "Forbidden", 403
-    st = Storage()
-    all_users = st.get_all_users()
+    today = datetime.utcnow().date()
+    start = request.args.get("from") or (today - timedelta(days=30)).isoformat()
+    end = request.args.get("to") or today.isoformat()
     stats = {}
-    for u in all_users:
-        digests = st.get_digests(u)
-        stats[u] = {
-            "digests": len(digests),
-            "messages_total": sum(len(d.get('messages',[])) for d in digests),
-        }
-    return jsonify(stats)
+    for r in get_storage().get_rollups(start, end):
+        u = stats.setdefault(r["email"], {"digests": 0, "messages_total": 0, "score_sum": 0.0, "score_histogram": Counter(), "reasons": Counter(), "days": 0})
+        u["digests"] += r["digests"]; u["messages_total"] += r["messages"]; u["score_sum"] += r["score_sum"]; u["days"] += 1
+        u["score_histogram"].update(r["score_hist"]); u["reasons"].update(r["reasons"])
+    reasons = Counter()
+    for u in stats.values():
+        u["avg_score"] = round(u.pop("score_sum") / u["messages_total"], 3) if u["messages_total"] else None
+        reasons.update(u["reasons"])
+    runs = sum(u["digests"] for u in stats.values())
+    total = sum(u["messages_total"] for u in stats.values())
+    return jsonify({"from": start, "to": end, "runs": runs, "total_messages": total,
+                    "avg_per_run": total / runs if runs else 0, "top_reasons": reasons.most_common(5), "users": stats})
@@ -4,6 +4,9 @@ GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
 
 def exchange_code_for_id(code: str, redirect_uri: str) -> dict:
+    """Identify the user behind an authorization code. Also returns the
+    offline refresh token (None when Google didn't issue one) and the
+    granted scopes."""
     token_resp = requests.post("https://oauth2.googleapis.com/token", data={
         "code": code,
         "client_id": GOOGLE_CLIENT_ID,
@@ -14,4 +17,5 @@ def exchange_code_for_id(code: str, redirect_uri: str) -> dict:
     id_token = token_resp.get("id_token")
     if not id_token: raise RuntimeError("Failed to exchange code for token")
     userinfo = requests.get("https://oauth2.googleapis.com/tokeninfo", params={"id_token": id_token}).json()
-    return {"email": userinfo.get("email"), "name": userinfo.get("name")}
+    return {"email": userinfo.get("email"), "name": userinfo.get("name"),
+            "refresh_token": token_resp.get("refresh_token"), "scopes": token_resp.get("scope", "").split()}
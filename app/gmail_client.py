@@ -1,46 +1,312 @@
-import os
-from datetime import datetime, timezone as dtz
-from typing import List, Dict
+import os, json, time, random, logging, threading
+from datetime import datetime, timedelta, timezone as dtz
+from typing import List, Dict, Iterator
+import httplib2, requests
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from ranking import message_timestamp
+import metrics
+
+logger = logging.getLogger(__name__)
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+METADATA_HEADERS = ["Subject","From","To","Date"]
+
+# Gmail recommends at most 50 calls per batch; larger batches trip per-user rate limits.
+BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+BATCH_RETRIES = int(os.getenv("GMAIL_BATCH_RETRIES", "4"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Gmail also signals throttling as a 403 carrying one of these reasons.
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# Upper bound on messages pulled per digest window; pages are followed until this is reached.
+MAX_MESSAGES = int(os.getenv("GMAIL_MAX_MESSAGES", "500"))
+# Refresh the access token this many seconds before Google says it expires.
+TOKEN_REFRESH_SKEW = int(os.getenv("GMAIL_TOKEN_REFRESH_SKEW", "300"))
+HTTP_TIMEOUT = 30
+# Per-mailbox pacing in Gmail quota units per second (Google allows 250 per user).
+# Every call and every batched sub-request is charged as a messages.get (5 units).
+USER_QUOTA_PER_SECOND = float(os.getenv("GMAIL_USER_QUOTA_PER_SECOND", "250"))
+REQUEST_UNITS = 5
+
+class RateLimiter:
+    """Token bucket shared by all threads using one mailbox. acquire() blocks
+    until `cost` units are available; a cost above the burst size is let
+    through and paid back as debt, so one large batch can't deadlock."""
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate; self.burst = burst or rate
+        self.tokens = self.burst; self.at = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+    def acquire(self, cost: float = 1.0):
+        if self.rate <= 0: return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+            self.at = now
+            wait = 0.0 if self.tokens >= min(cost, self.burst) else (min(cost, self.burst) - self.tokens) / self.rate
+            self.tokens -= cost
+            self.waited_seconds += wait
+        # Sleeping outside the lock; the debt already reserved our share.
+        if wait > 0: time.sleep(wait)
+
+class _MeteredHttp(AuthorizedHttp):
+    """Paces requests through the mailbox's RateLimiter and counts every HTTP
+    round trip to Gmail by method and status; a batch call is one round trip."""
+    def __init__(self, credentials, limiter: RateLimiter, **kwargs):
+        super().__init__(credentials, **kwargs)
+        self.limiter = limiter
+    def request(self, uri, method="GET", body=None, *args, **kwargs):
+        parts = 1
+        if "/batch/" in uri and body:
+            parts = body.count(b"Content-ID:" if isinstance(body, bytes) else "Content-ID:")
+        self.limiter.acquire(REQUEST_UNITS * max(1, parts))
+        resp, content = super().request(uri, method, body, *args, **kwargs)
+        metrics.inc("gmail_requests_total", method=method, status=resp.status)
+        return resp, content
+
+class GmailServiceManager:
+    """Owns one mailbox's OAuth credentials and Gmail clients for the life of
+    the process. The access token is reused until shortly before expiry and
+    refreshed under a lock, token refreshes go over a pooled requests session,
+    and each thread gets its own discovery client since httplib2 connections
+    are not thread-safe."""
+
+    def __init__(self, refresh_token: str):
+        self.creds = Credentials(
+            None,
+            refresh_token=refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=os.environ.get("GOOGLE_CLIENT_ID"),
+            client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
+            scopes=SCOPES,
+        )
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._request = Request(session=requests.Session())
+        self.refresh_count = 0
+        self.refresh_seconds_total = 0.0
+        self.refresh_seconds_last = 0.0
+        self.service_builds = 0
+        self.limiter = RateLimiter(USER_QUOTA_PER_SECOND)
+
+    def _needs_refresh(self) -> bool:
+        c = self.creds
+        return not c.token or c.expiry is None or c.expiry - timedelta(seconds=TOKEN_REFRESH_SKEW) <= datetime.utcnow()
+
+    def credentials(self) -> Credentials:
+        if self._needs_refresh():
+            with self._lock:
+                if self._needs_refresh():
+                    t0 = time.perf_counter()
+                    self.creds.refresh(self._request)
+                    elapsed = time.perf_counter() - t0
+                    self.refresh_count += 1
+                    self.refresh_seconds_total += elapsed; self.refresh_seconds_last = elapsed
+                    logger.info("Gmail token refreshed in %.3fs (refresh #%d)", elapsed, self.refresh_count)
+        return self.creds
+
+    def service(self):
+        self.credentials()
+        svc = getattr(self._local, "service", None)
+        if svc is None:
+            http = _MeteredHttp(self.creds, self.limiter, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            svc = self._local.service = build("gmail", "v1", http=http, cache_discovery=False)
+            with self._lock:
+                self.service_builds += 1
+        return svc
+
+    def stats(self) -> Dict:
+        return {
+            "refresh_count": self.refresh_count,
+            "refresh_seconds_total": round(self.refresh_seconds_total, 4),
+            "refresh_seconds_last": round(self.refresh_seconds_last, 4),
+            "service_builds": self.service_builds,
+            "rate_limited_seconds": round(self.limiter.waited_seconds, 4),
+            "token_expiry": self.creds.expiry.isoformat() if self.creds.expiry else None,
+        }
+
+_managers: Dict[str, GmailServiceManager] = {}
+_managers_lock = threading.Lock()
+
+def get_service_manager(refresh_token: str = None) -> GmailServiceManager:
+    refresh_token = refresh_token or os.environ.get("GMAIL_REFRESH_TOKEN")
+    with _managers_lock:
+        mgr = _managers.get(refresh_token)
+        if mgr is None:
+            mgr = _managers[refresh_token] = GmailServiceManager(refresh_token)
+        return mgr
+
+def service_stats() -> Dict:
+    """Numeric stats summed over every mailbox this process has opened."""
+    with _managers_lock:
+        managers = list(_managers.values())
+    totals: Dict = {"mailboxes": len(managers)}
+    for mgr in managers:
+        for k, v in mgr.stats().items():
+            if isinstance(v, (int, float)): totals[k] = round(totals.get(k, 0) + v, 4)
+    return totals
 
 def build_gmail_service():
-    creds = Credentials(
-        None,
-        refresh_token=os.environ.get("GMAIL_REFRESH_TOKEN"),
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.environ.get("GOOGLE_CLIENT_ID"),
-        client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
-        scopes=SCOPES,
-    )
-    creds.refresh(Request())
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
-
-def fetch_recent_messages(service, since: datetime) -> List[Dict]:
-    now = datetime.now(dtz.utc)
-    delta_days = max(1, int((now - since).total_seconds() // 86400))
-    q = f"newer_than:{delta_days}d"
-    results = service.users().messages().list(userId="me", q=q, maxResults=100).execute()
-    msgs = []
-    for item in results.get("messages", []):
-        msg = service.users().messages().get(userId="me", id=item["id"], format="metadata", metadataHeaders=["Subject","From","To","Date"]).execute()
-        payload = msg.get("payload", {})
-        headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
-        subject = headers.get("subject",""); from_ = headers.get("from",""); to = headers.get("to",""); date = headers.get("date","")
-        snippet = msg.get("snippet",""); labels = msg.get("labelIds", [])
-        msgs.append({
-            "id": msg["id"],
-            "threadId": msg["threadId"],
-            "subject": subject,
-            "from": from_,
-            "to": to,
-            "date": date,
-            "snippet": snippet,
-            "labels": labels,
-            "historyId": msg.get("historyId"),
-            "internalDate": msg.get("internalDate"),
-        })
+    return get_service_manager().service()
+
+def _normalize(msg: Dict) -> Dict:
+    payload = msg.get("payload", {})
+    headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
+    normalized = {
+        "id": msg["id"],
+        "threadId": msg["threadId"],
+        "subject": headers.get("subject",""),
+        "from": headers.get("from",""),
+        "to": headers.get("to",""),
+        "date": headers.get("date",""),
+        "snippet": msg.get("snippet",""),
+        "labels": msg.get("labelIds", []),
+        "historyId": msg.get("historyId"),
+        "internalDate": msg.get("internalDate"),
+    }
+    normalized["ts"] = message_timestamp(normalized)
+    return normalized
+
+def _get_request(service, msg_id: str):
+    return service.users().messages().get(userId="me", id=msg_id, format="metadata", metadataHeaders=METADATA_HEADERS)
+
+def _retryable(e: HttpError) -> bool:
+    if e.resp.status in RETRYABLE_STATUS: return True
+    if e.resp.status != 403: return False
+    try:
+        errors = json.loads(e.content.decode("utf-8"))["error"].get("errors", [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return any(err.get("reason") in RATE_LIMIT_REASONS for err in errors if isinstance(err, dict))
+
+def _backoff(attempt: int):
+    time.sleep(min(32.0, 2 ** attempt) + random.random())
+
+def _fetch_chunk(service, ids: List[str]) -> Dict[str, Dict]:
+    """Fetch one chunk of message ids in a single batch HTTP call, retrying
+    sub-requests that were throttled or failed transiently."""
+    got: Dict[str, Dict] = {}
+    pending = list(ids)
+    for attempt in range(BATCH_RETRIES + 1):
+        retry = []
+        def cb(request_id, response, exception):
+            if exception is None:
+                got[request_id] = response
+            elif isinstance(exception, HttpError) and _retryable(exception):
+                retry.append(request_id)
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                pass  # deleted between list() and get()
+            else:
+                raise exception
+        batch = service.new_batch_http_request(callback=cb)
+        for msg_id in pending:
+            batch.add(_get_request(service, msg_id), request_id=msg_id)
+        metrics.inc("gmail_batch_items_total", len(pending), retry=bool(attempt))
+        try:
+            batch.execute()
+        except HttpError as e:
+            if not _retryable(e) or attempt == BATCH_RETRIES: raise
+            retry = [i for i in pending if i not in got]
+        if not retry: break
+        if attempt == BATCH_RETRIES:
+            raise RuntimeError(f"Gmail batch fetch gave up on {len(retry)} messages after {BATCH_RETRIES} retries")
+        pending = retry
+        _backoff(attempt)
+    return got
+
+@metrics.stage("gmail.fetch_messages")
+def fetch_messages(service, ids: List[str], batch_size: int = None) -> List[Dict]:
+    """Fetch and normalize metadata for `ids`, one batch round trip per chunk.
+    Order follows `ids`; messages that vanished in the meantime are skipped."""
+    batch_size = max(1, min(100, batch_size or BATCH_SIZE))
+    raw: Dict[str, Dict] = {}
+    for i in range(0, len(ids), batch_size):
+        raw.update(_fetch_chunk(service, ids[i:i+batch_size]))
+    return [_normalize(raw[i]) for i in ids if i in raw]
+
+def _window_days(since: datetime) -> int:
+    return max(1, int((datetime.now(dtz.utc) - since).total_seconds() // 86400))
+
+def iter_recent_messages(service, since: datetime, limit: int = None, batch_size: int = None) -> Iterator[Dict]:
+    """Lazily page through messages newer than `since`, yielding normalized
+    dicts one batch at a time. Stops after `limit` messages (MAX_MESSAGES by
+    default) so an enormous window can't run away with memory or quota."""
+    q = f"newer_than:{_window_days(since)}d"
+    limit = MAX_MESSAGES if limit is None else limit
+    batch_size = max(1, min(100, batch_size or BATCH_SIZE))
+    remaining = limit; page_token = None
+    while remaining > 0:
+        results = service.users().messages().list(userId="me", q=q, maxResults=min(500, remaining), pageToken=page_token).execute()
+        ids = [item["id"] for item in results.get("messages", [])][:remaining]
+        remaining -= len(ids)
+        for i in range(0, len(ids), batch_size):
+            yield from fetch_messages(service, ids[i:i+batch_size], batch_size)
+        page_token = results.get("nextPageToken")
+        if not page_token: break
+
+@metrics.stage("gmail.fetch_recent_messages")
+def fetch_recent_messages(service, since: datetime, limit: int = None, batch_size: int = None) -> List[Dict]:
+    return list(iter_recent_messages(service, since, limit, batch_size))
+
+# --- Incremental sync ---
+HIDDEN_LABELS = {"TRASH", "SPAM"}
+
+def _apply_history(service, start_history_id: str, cached: Dict[str, Dict]) -> str:
+    """Replay mailbox history since `start_history_id` onto `cached` (id ->
+    message). Returns the mailbox's current historyId. Raises HttpError 404
+    when the start id is too old for Gmail to replay."""
+    added, removed = [], set()
+    history_id, page_token = start_history_id, None
+    while True:
+        resp = service.users().history().list(
+            userId="me", startHistoryId=start_history_id, pageToken=page_token,
+            historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+        ).execute()
+        for h in resp.get("history", []):
+            for x in h.get("messagesAdded", []):
+                added.append(x["message"]["id"]); removed.discard(x["message"]["id"])
+            for x in h.get("messagesDeleted", []):
+                removed.add(x["message"]["id"])
+            for x in h.get("labelsAdded", []):
+                if HIDDEN_LABELS & set(x.get("labelIds", [])): removed.add(x["message"]["id"])
+            for x in h.get("labelsRemoved", []):
+                if HIDDEN_LABELS & set(x.get("labelIds", [])):
+                    added.append(x["message"]["id"]); removed.discard(x["message"]["id"])
+        history_id = resp.get("historyId", history_id)
+        page_token = resp.get("nextPageToken")
+        if not page_token: break
+    for msg_id in removed:
+        cached.pop(msg_id, None)
+    new_ids = list(dict.fromkeys(i for i in added if i not in cached and i not in removed))
+    for m in fetch_messages(service, new_ids):
+        if not HIDDEN_LABELS & set(m["labels"]): cached[m["id"]] = m
+    return history_id
+
+@metrics.stage("gmail.sync_recent_messages")
+def sync_recent_messages(service, since: datetime, st, mailbox: str = "me") -> List[Dict]:
+    """Like fetch_recent_messages, but keeps the window's messages and the last
+    historyId in Storage and only fetches what changed since the previous run.
+    Falls back to a full listing when there is no state or the historyId has
+    expired."""
+    days = _window_days(since)
+    state = st.get_sync_state(mailbox, days)
+    cached = None
+    if state:
+        cached = {m["id"]: m for m in state.get("messages", [])}
+        try:
+            history_id = _apply_history(service, state["history_id"], cached)
+        except HttpError as e:
+            if e.resp.status != 404: raise
+            cached = None
+    if cached is None:
+        # Read the profile's historyId first so nothing arriving mid-listing is missed next time.
+        history_id = service.users().getProfile(userId="me").execute()["historyId"]
+        cached = {m["id"]: m for m in iter_recent_messages(service, since)}
+    cutoff_ms = int((datetime.now(dtz.utc).timestamp() - days * 86400) * 1000)
+    msgs = sorted((m for m in cached.values() if int(m.get("internalDate") or 0) >= cutoff_ms),
+                  key=lambda m: int(m.get("internalDate") or 0), reverse=True)[:MAX_MESSAGES]
+    st.save_sync_state(mailbox, days, history_id, msgs)
     return msgs
@@ -0,0 +1,108 @@
+import os, re, hashlib, threading
+from typing import Dict, List, Optional
+import numpy as np
+import metrics
+
+# Stages run between fetch and ranking; both on by default.
+COLLAPSE_THREADS = os.getenv("DIGEST_COLLAPSE_THREADS", "1") == "1"
+COLLAPSE_NEAR_DUPLICATES = os.getenv("DIGEST_COLLAPSE_NEAR_DUPLICATES", "1") == "1"
+# Two messages from the same sender whose SimHash fingerprints differ in at most
+# this many of 64 bits are treated as one template (e.g. "Order #1234 shipped").
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", "3"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+_DIGITS = re.compile(r"\d+")
+
+_fingerprints: Dict[tuple, int] = {}
+_fingerprints_lock = threading.Lock()
+
+def _features(msg: Dict) -> List[str]:
+    # Numbers are masked so order ids, dates and amounts don't separate a template.
+    text = _DIGITS.sub("0", f"{msg.get('subject') or ''} {msg.get('snippet') or ''}".lower())
+    words = _WORD.findall(text)
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def simhash(msg: Dict) -> int:
+    """64-bit SimHash of the masked subject and snippet words and bigrams."""
+    feats = _features(msg)
+    if not feats: return 0
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "big") for f in feats], dtype=">u8")
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(feats)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+def fingerprint(msg: Dict, mailbox: str = "me") -> int:
+    """simhash(msg), cached per Gmail message (messages are immutable). Ids are
+    only unique within a mailbox, so the cache is keyed by both."""
+    key = (mailbox, msg.get("id"))
+    with _fingerprints_lock:
+        fp = _fingerprints.get(key)
+    if fp is None:
+        fp = simhash(msg)
+        with _fingerprints_lock:
+            if len(_fingerprints) > 50000: _fingerprints.clear()
+            _fingerprints[key] = fp
+    return fp
+
+def _sender(msg: Dict) -> str:
+    addr = msg.get("from") or ""
+    m = re.search(r"<([^>]+)>", addr)
+    return (m.group(1) if m else addr).strip().lower()
+
+# What ranking needs of each member to score a group on all of them.
+MEMBER_FIELDS = ("id", "from", "subject", "snippet", "labels", "ts", "internalDate", "date")
+
+def _merge(group: List[Dict]) -> Dict:
+    """One entry for `group` (newest first): the newest message's subject and
+    snippet, carrying how many messages it stands for, their ids and their
+    scoring fields as "members" (ranking scores the group on all of them).
+    The sender shown is the newest one that isn't the user's own reply."""
+    members = [x for m in group for x in m.get("members") or [{k: m.get(k) for k in MEMBER_FIELDS}]]
+    shown = next((x for x in members if "SENT" not in (x.get("labels") or [])), members[0])
+    return {**group[0], "from": shown.get("from"), "count": len(members),
+            "message_ids": [x["id"] for x in members], "members": members}
+
+def _newest_first(messages: List[Dict]) -> List[Dict]:
+    return sorted(messages, key=lambda m: m.get("ts") or 0, reverse=True)
+
+def collapse_threads(messages: List[Dict]) -> List[Dict]:
+    """One entry per threadId, from its newest message (so the latest snippet)."""
+    threads: Dict[str, List[Dict]] = {}
+    for m in _newest_first(messages):
+        threads.setdefault(m.get("threadId") or m["id"], []).append(m)
+    return [_merge(g) for g in threads.values()]
+
+def _bands(max_distance: int) -> List[tuple]:
+    """(shift, mask) of max_distance + 1 disjoint bit ranges covering all 64
+    bits: by pigeonhole, fingerprints within max_distance bits of each other
+    agree on at least one of them."""
+    if not 0 <= max_distance < 64: raise ValueError("max_distance must be between 0 and 63")
+    edges = [64 * i // (max_distance + 1) for i in range(max_distance + 2)]
+    return [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:])]
+
+def collapse_near_duplicates(messages: List[Dict], mailbox: str = "me", max_distance: int = SIMHASH_MAX_DISTANCE) -> List[Dict]:
+    """Merge messages from the same sender with near-identical text, found by
+    SimHash fingerprint bands instead of comparing every pair."""
+    bands = _bands(max_distance)
+    index: Dict[tuple, List[int]] = {}
+    groups: List[List[Dict]] = []; prints: List[int] = []
+    for m in _newest_first(messages):
+        fp, sender = fingerprint(m, mailbox), _sender(m)
+        keys = [(sender, shift, (fp >> shift) & mask) for shift, mask in bands]
+        match = next((g for k in keys for g in index.get(k, ()) if bin(prints[g] ^ fp).count("1") <= max_distance), None)
+        if match is None:
+            match = len(groups); groups.append([]); prints.append(fp)
+            for k in keys: index.setdefault(k, []).append(match)
+        groups[match].append(m)
+    return [_merge(g) if len(g) > 1 else g[0] for g in groups]
+
+@metrics.stage("group")
+def group_messages(messages: List[Dict], mailbox: str = "me", threads: Optional[bool] = None, near_duplicates: Optional[bool] = None) -> List[Dict]:
+    """The grouping stage between fetch and ranking. Input messages are not
+    modified; grouped entries are new dicts with "count", "message_ids" and
+    "members"."""
+    threads = COLLAPSE_THREADS if threads is None else threads
+    near_duplicates = COLLAPSE_NEAR_DUPLICATES if near_duplicates is None else near_duplicates
+    if threads: messages = collapse_threads(messages)
+    if near_duplicates: messages = collapse_near_duplicates(messages, mailbox)
+    return messages
@@ -0,0 +1,88 @@
+import os, time, queue, logging, threading
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any, Optional
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# A queued/running job not updated for this long is assumed orphaned (e.g. the
+# worker process was recycled) and may be picked up again by a new trigger.
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "900"))
+PROGRESS_INTERVAL = 1.0
+
+def job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in job.items() if k not in ("pk",) and not k.startswith("_")}
+
+class JobQueue:
+    """Background executor for digest runs.
+
+    Jobs are stored through Storage under their run id, so a retried trigger
+    for the same run finds the existing job rather than starting a second
+    pipeline. Only failed or stale jobs are requeued. Work runs on a single
+    daemon thread per process, started on first use."""
+
+    def __init__(self, runner: Callable, storage_factory: Callable):
+        self.runner = runner
+        self.storage_factory = storage_factory
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _requeueable(self, job: Dict[str, Any]) -> bool:
+        if job["status"] == "failed": return True
+        if job["status"] == "done": return False
+        age = datetime.utcnow() - datetime.fromisoformat(job["updated_at"])
+        return age > timedelta(seconds=JOB_STALE_SECONDS)
+
+    def submit(self, st, run_id: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        job, created = st.create_job(run_id, params or {})
+        if not created:
+            if not self._requeueable(job): return job
+            claimed = st.update_job(job, status="queued", error=None, progress={})
+            if claimed is None: return st.get_job(run_id)  # another trigger requeued it
+            job = claimed
+        self._ensure_worker()
+        self._queue.put(run_id)
+        return job
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name="digest-jobs", daemon=True)
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            run_id = self._queue.get()
+            try:
+                self._run(run_id)
+            except Exception:
+                logger.exception("Digest job %s crashed", run_id)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, run_id: str):
+        st = self.storage_factory()
+        job = st.get_job(run_id)
+        if job is None or job["status"] != "queued": return
+        job = st.update_job(job, status="running")
+        if job is None: return
+        state = {"job": job, "at": 0.0}
+        def progress(**fields):
+            # Throttled so a large fan-out doesn't turn into one write per recipient.
+            now = time.monotonic()
+            if now - state["at"] < PROGRESS_INTERVAL: return
+            updated = st.update_job(state["job"], progress=fields)
+            if updated is not None: state["job"] = updated
+            state["at"] = now
+        params = job.get("params") or {}
+        try:
+            # {"profile": true} runs dump a cProfile of the whole job (when PROFILE_DIR is set).
+            with metrics.profiled(f"job-{run_id}") if params.get("profile") else nullcontext():
+                result = self.runner(st, params, progress)
+        except Exception as e:
+            logger.exception("Digest job %s failed", run_id)
+            st.update_job(st.get_job(run_id), status="failed", error=str(e))
+            return
+        st.update_job(st.get_job(run_id), status="done", result=result, progress=result)
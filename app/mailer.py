@@ -1,21 +1,56 @@
-import os
+import os, time, threading
 from typing import List, Dict
-from sendgrid import SendGridAPIClient
+import requests
+from requests.adapters import HTTPAdapter
 from sendgrid.helpers.mail import Mail
+from render import render_digest
+import metrics
 
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
+SENDGRID_API_URL = os.getenv("SENDGRID_API_URL", "https://api.sendgrid.com/v3/mail/send")
+SEND_TIMEOUT = float(os.getenv("SENDGRID_TIMEOUT_SECONDS", "10"))
+SEND_RETRIES = int(os.getenv("SENDGRID_RETRIES", "2"))
+# Upper bound on concurrent sends; also sizes the shared connection pool.
+SEND_WORKERS = int(os.getenv("DIGEST_WORKERS", "8"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+def _mail_session() -> requests.Session:
+    """One keep-alive session for all SendGrid calls in the process, instead of
+    a fresh SendGridAPIClient (and TLS handshake) per recipient."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = requests.Session()
+            s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=SEND_WORKERS))
+            s.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=SEND_WORKERS))
+            s.headers.update({"Authorization": f"Bearer {SENDGRID_API_KEY}"})
+            _session = s
+        return _session
+
+def send_mail(message: Mail):
+    """POST one message to SendGrid, retrying throttled and transient failures
+    with backoff. Raises once retries are exhausted."""
+    for attempt in range(SEND_RETRIES + 1):
+        try:
+            resp = _mail_session().post(SENDGRID_API_URL, json=message.get(), timeout=SEND_TIMEOUT)
+            metrics.inc("sendgrid_requests_total", status=resp.status_code)
+            if resp.status_code not in RETRYABLE_STATUS:
+                resp.raise_for_status()
+                return resp
+            err = requests.HTTPError(f"SendGrid returned {resp.status_code}", response=resp)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc("sendgrid_requests_total", status=type(e).__name__)
+            err = e
+        if attempt == SEND_RETRIES: raise err
+        time.sleep(0.5 * 2 ** attempt)
 
 def format_html(email: str, messages: List[Dict], theme: str = 'light', top_n: int = 20) -> str:
-    rows = []
-    for m in messages[:top_n]:
-        reasons = " • ".join(m.get("reasons", []))
-        rows.append(f"<tr><td style='padding:8px;border-bottom:1px solid #eee'>{m.get('from','')}</td>"
-                    f"<td style='padding:8px;border-bottom:1px solid #eee'><b>{m.get('subject','(no subject)')}</b><br>"
-                    f"<div style='color:#555'>{m.get('snippet','')}</div>"
-                    f"<div style='font-size:12px;color:#777;margin-top:4px'>{reasons}</div></td></tr>")
-    table = "<table width='100%' cellpadding='0' cellspacing='0' style='border-collapse:collapse'>" + "".join(rows) + "</table>"
-    return f"<div style='font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial,sans-serif'><h2>Your Gmail Digest</h2>{table}<p style='color:#888'>{min(top_n,len(messages))} shown.</p></div>"
+    return render_digest(email, messages, theme, top_n)
 
+@metrics.stage("email")
 def email_digest(recipient: str, messages: List[Dict], prefs: Dict):
     threshold = float((prefs or {}).get('importance_threshold', 0.0))
     if threshold:
@@ -32,5 +67,4 @@ def email_digest(recipient: str, messages: List[Dict], prefs: Dict):
         subject="Your Gmail Digest",
         html_content=html
     )
-    sg = SendGridAPIClient(SENDGRID_API_KEY)
-    sg.send(message)
+    send_mail(message)
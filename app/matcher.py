@@ -0,0 +1,81 @@
+from typing import Dict, Iterable, List, Sequence
+
+# Below this many keywords, per-category `in` scans (which run in C) beat a
+# pure-Python automaton walk; above it the automaton's single pass wins.
+AUTOMATON_MIN_KEYWORDS = 48
+
+class _Automaton:
+    """Aho-Corasick automaton over lowercase keywords; each keyword carries a
+    bitmask of the categories it belongs to."""
+
+    def __init__(self, keywords: Dict[str, int]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[int] = [0]
+        for kw, mask in keywords.items():
+            state = 0
+            for ch in kw:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = goto[state][ch] = len(goto)
+                    goto.append({}); out.append(0)
+                state = nxt
+            out[state] |= mask
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, nxt in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if state else 0
+                out[nxt] |= out[fail[nxt]]
+                queue.append(nxt)
+        self.goto, self.fail, self.out = goto, fail, out
+
+    def scan(self, text: str, stop: int) -> int:
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0; mask = 0
+        if not stop: return mask
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                mask |= out[state]
+                if mask & stop == stop: break
+        return mask
+
+class MultiMatcher:
+    """Classifies text against several keyword categories at once.
+
+    `match(text)` returns a bitmask whose bit i is set exactly when
+    `any(k in text for k in categories[i])` would be true for the lowercased
+    keywords, including the empty-keyword-matches-everything edge case.
+    `text` must already be lowercase."""
+
+    def __init__(self, categories: Sequence[Iterable[str]]):
+        # Only categories with keywords can ever match, so only they count
+        # towards "every bit found" (empty placeholders keep rule bit positions).
+        self.full = 0
+        self.always = 0
+        merged: Dict[str, int] = {}
+        self.lists = []
+        for i, kws in enumerate(categories):
+            kws = tuple(dict.fromkeys(k.lower() for k in kws))
+            self.lists.append((1 << i, kws))
+            if kws: self.full |= 1 << i
+            if "" in kws: self.always |= 1 << i
+            for k in kws:
+                if k: merged[k] = merged.get(k, 0) | (1 << i)
+        self.automaton = _Automaton(merged) if len(merged) >= AUTOMATON_MIN_KEYWORDS else None
+        self.lists = [(bit, kws) for bit, kws in self.lists if kws and not bit & self.always]
+
+    def match(self, text: str) -> int:
+        mask = self.always
+        if self.automaton is not None:
+            return mask | self.automaton.scan(text, self.full & ~mask)
+        for bit, kws in self.lists:
+            for k in kws:
+                if k in text:
+                    mask |= bit; break
+        return mask
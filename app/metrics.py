@@ -0,0 +1,122 @@
+import os, re, time, cProfile, functools, threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Tuple
+
+PREFIX = "gmail_digest_"
+# Upper bounds (seconds) of the stage latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# cProfile dumps are only written when this is set; ?profile=1 is ignored otherwise.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Registry:
+    """Process-wide counters and histograms, rendered in the Prometheus text
+    exposition format. Series are keyed by (name, sorted labels)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, list]] = {}
+
+    def inc(self, name: str, amount: float = 1.0, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            h = self.histograms.setdefault(name, {}).get(key)
+            if h is None:
+                h = self.histograms[name][key] = [0] * len(BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound: h[i] += 1
+            h[-2] += value; h[-1] += 1
+
+    def render(self, gauges: Iterable[Tuple[str, Dict[str, str], float]] = ()) -> str:
+        """The exposition text; `gauges` are (name, labels, value) snapshots
+        taken by the caller, e.g. cache sizes."""
+        out = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                out.append(f"# TYPE {PREFIX}{name} counter")
+                out += [f"{PREFIX}{name}{_labels(k)} {_num(v)}" for k, v in sorted(series.items())]
+            for name, series in sorted(self.histograms.items()):
+                out.append(f"# TYPE {PREFIX}{name} histogram")
+                for k, h in sorted(series.items()):
+                    # observe() bumps every bucket a value fits under, so counts are already cumulative.
+                    for bound, count in zip(BUCKETS, h):
+                        out.append(f"{PREFIX}{name}_bucket{_labels(k + (('le', _num(bound)),))} {count}")
+                    out.append(f"{PREFIX}{name}_bucket{_labels(k + (('le', '+Inf'),))} {h[-1]}")
+                    out.append(f"{PREFIX}{name}_sum{_labels(k)} {_num(h[-2])}")
+                    out.append(f"{PREFIX}{name}_count{_labels(k)} {h[-1]}")
+        typed = set()
+        for name, labels, value in gauges:
+            if name not in typed:
+                out.append(f"# TYPE {PREFIX}{name} gauge"); typed.add(name)
+            out.append(f"{PREFIX}{name}{_labels(tuple(sorted(labels.items())))} {_num(value)}")
+        return "\n".join(out) + "\n"
+
+def _labels(key: Labels) -> str:
+    if not key: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in key) + "}"
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+@contextmanager
+def timed(stage: str):
+    """Record the block's latency under `stage`, plus call and error counts."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc("stage_errors_total", stage=stage)
+        raise
+    finally:
+        observe("stage_seconds", time.perf_counter() - start, stage=stage)
+        inc("stage_calls_total", stage=stage)
+
+def stage(name: str) -> Callable:
+    """Decorator form of timed()."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            with timed(name):
+                return fn(*args, **kwargs)
+        timed_fn.__stage__ = name
+        return timed_fn
+    return wrap
+
+def instrument(cls, prefix: str):
+    """Time every public method `cls` has, inherited ones included, as
+    "<prefix>.<method>". Idempotent."""
+    for attr in dir(cls):
+        fn = getattr(cls, attr)
+        if attr.startswith("_") or not callable(fn) or hasattr(fn, "__stage__"): continue
+        setattr(cls, attr, stage(f"{prefix}.{attr}")(fn))
+    return cls
+
+@contextmanager
+def profiled(name: str):
+    """cProfile the block on the current thread and dump the stats to
+    PROFILE_DIR/<name>-<ms>.prof (readable with pstats or snakeviz). Yields the
+    dump path, or None when profiling is disabled."""
+    if not PROFILE_DIR:
+        yield None
+        return
+    path = os.path.join(PROFILE_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{int(time.time() * 1000)}.prof")
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield path
+    finally:
+        prof.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        prof.dump_stats(path)
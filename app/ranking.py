@@ -1,6 +1,11 @@
-from typing import List, Dict
-from datetime import datetime
+import heapq, time
+from functools import lru_cache
+from typing import List, Dict, Iterable, Optional
+from datetime import timezone as dtz
 from email.utils import parsedate_to_datetime
+import numpy as np
+from matcher import MultiMatcher
+import metrics
 
 DEFAULT_WEIGHTS = {
     "vip": 5.0,
@@ -16,48 +21,193 @@ DEFAULT_WEIGHTS = {
 URGENT_TERMS = ["urgent", "asap", "immediately", "deadline", "due", "action required"]
 MONEY_TERMS = ["invoice", "payment", "paid", "unpaid", "bill", "receipt", "quote", "estimate"]
 
-def _score(msg: Dict, prefs: Dict, weights: Dict) -> (float, List[str]):
+# Match-mask bits for each reason category, in the order reasons are reported.
+VIP, BLOCKED, ALWAYS, MUTE, URGENT, MONEY = (1 << i for i in range(6))
+SENDER_RULES = [(VIP, "vip", "VIP"), (BLOCKED, "blocked", "Blocked sender")]
+TEXT_RULES = [(ALWAYS, "always_kw", "Always-show keyword"), (MUTE, "mute_kw", "Muted keyword"),
+              (URGENT, "urgent_kw", "Deadline/Urgent"), (MONEY, "money_kw", "Billing/Invoice")]
+
+@lru_cache(maxsize=256)
+def _compile(vip: tuple, blocked: tuple, always: tuple, mute: tuple):
+    """One matcher for sender rules and one for subject+snippet rules, so each
+    message is classified in a single pass per field."""
+    return MultiMatcher([vip, blocked]), MultiMatcher([(), (), always, mute, URGENT_TERMS, MONEY_TERMS])
+
+def compile_prefs(prefs: Dict):
+    return _compile(*(tuple(prefs.get(k, [])) for k in ("vip_senders", "blocked_senders", "always_keywords", "mute_keywords")))
+
+def message_timestamp(msg: Dict) -> Optional[float]:
+    """Epoch seconds for a message: Gmail's internalDate when present, else
+    the Date header (naive dates taken as UTC), else None."""
+    if msg.get("internalDate"):
+        return int(msg["internalDate"]) / 1000.0
+    try:
+        dt = parsedate_to_datetime(msg.get("date"))
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=dtz.utc)
+    return dt.timestamp()
+
+def _age_hours(msg: Dict, now: float) -> Optional[float]:
+    ts = msg.get("ts")
+    if ts is None: ts = message_timestamp(msg)
+    if ts is None: return None
+    return max(0.0, (now - ts) / 3600.0)
+
+def _score(msg: Dict, prefs: Dict, weights: Dict, matchers=None, now: float = None) -> (float, List[str]):
     score = 0.0; reasons = []
     sender = (msg.get("from") or "").lower()
     subj = (msg.get("subject") or "").lower()
     snip = (msg.get("snippet") or "").lower()
     text = f"{subj} {snip}"
 
-    vip = [s.lower() for s in prefs.get("vip_senders", [])]
-    blocked = [s.lower() for s in prefs.get("blocked_senders", [])]
-    always = [k.lower() for k in prefs.get("always_keywords", [])]
-    mute = [k.lower() for k in prefs.get("mute_keywords", [])]
-
-    if any(v in sender for v in vip):
-        score += weights["vip"]; reasons.append("VIP")
-    if any(b in sender for b in blocked):
-        score += weights["blocked"]; reasons.append("Blocked sender")
-    if any(k in text for k in always):
-        score += weights["always_kw"]; reasons.append("Always-show keyword")
-    if any(k in text for k in mute):
-        score += weights["mute_kw"]; reasons.append("Muted keyword")
-    if any(k in text for k in URGENT_TERMS):
-        score += weights["urgent_kw"]; reasons.append("Deadline/Urgent")
-    if any(k in text for k in MONEY_TERMS):
-        score += weights["money_kw"]; reasons.append("Billing/Invoice")
+    sender_matcher, text_matcher = matchers or compile_prefs(prefs)
+    hits = sender_matcher.match(sender) | text_matcher.match(text)
+    for bit, key, reason in SENDER_RULES + TEXT_RULES:
+        if hits & bit:
+            score += weights[key]; reasons.append(reason)
 
-    try:
-        dt = parsedate_to_datetime(msg.get("date")) or datetime.utcnow()
-        hours = max(0.0, (datetime.utcnow() - dt.replace(tzinfo=None)).total_seconds()/3600.0)
+    hours = _age_hours(msg, time.time() if now is None else now)
+    if hours is not None:
         score += hours * weights["recency_decay_per_hour"]
-    except Exception:
-        pass
 
     urgency_bias = float(prefs.get("urgency_bias", 0.5))
     score += urgency_bias * 0.5
     return score, reasons
 
-def rank_messages(messages: List[Dict], prefs: Dict) -> List[Dict]:
+def _ranked(m: Dict, score: float, code: int) -> Dict:
+    out = {k: v for k, v in m.items() if k != "members"}
+    out["score"] = score; out["reasons"] = list(REASON_TABLE[code])
+    return out
+
+def _iter_scored(messages: Iterable[Dict], prefs: Dict, weights: Dict):
+    matchers = compile_prefs(prefs)
+    now = time.time()  # one clock reading per batch keeps scores consistent within a run
+    for m in messages:
+        # A grouped entry (grouping.py) is scored on all its members: the best
+        # member score, with every reason any member matched.
+        best = None; code = 0
+        for member in m.get("members") or [m]:
+            s, reasons = _score(member, prefs, weights, matchers, now)
+            best = s if best is None else max(best, s); code |= encode_reasons(reasons)
+        yield _ranked(m, round(best, 3), code)
+
+@metrics.stage("rank")
+def rank_messages(messages: Iterable[Dict], prefs: Dict, top_n: Optional[int] = None) -> List[Dict]:
+    """Score and sort `messages`, which may be a generator. With `top_n`, only
+    the best `top_n` are kept while streaming, so memory stays bounded."""
     weights = DEFAULT_WEIGHTS.copy()
     weights.update(prefs.get("weights", {}))
-    ranked = []
-    for m in messages:
-        s, reasons = _score(m, prefs, weights)
-        ranked.append({**m, "score": round(s, 3), "reasons": reasons})
-    ranked.sort(key=lambda x: x["score"], reverse=True)
-    return ranked
+    ranked = _iter_scored(messages, prefs, weights)
+    if top_n is not None:
+        return heapq.nlargest(top_n, ranked, key=lambda x: x["score"])
+    return sorted(ranked, key=lambda x: x["score"], reverse=True)
+
+# Reasons as a compact integer: the OR of their match-mask bits.
+REASON_TABLE = [[reason for bit, _, reason in SENDER_RULES + TEXT_RULES if code & bit] for code in range(64)]
+REASON_BITS = {reason: bit for bit, _, reason in SENDER_RULES + TEXT_RULES}
+
+def encode_reasons(reasons: List[str]) -> int:
+    return sum(REASON_BITS[r] for r in set(reasons))
+
+def decode_reasons(code: int) -> List[str]:
+    return list(REASON_TABLE[code])
+
+# --- Batch ranking for many recipients ---
+
+def _hit_matrix(texts: List[str], vocab: List[str]) -> np.ndarray:
+    """(len(texts), len(vocab)) 0/1 matrix: does keyword j occur in text i."""
+    if not vocab:
+        return np.zeros((len(texts), 0), dtype=np.float32)
+    matcher = MultiMatcher([[k] for k in vocab])
+    nbytes = (len(vocab) + 7) // 8
+    buf = b"".join(matcher.match(t).to_bytes(nbytes, "little") for t in texts)
+    bits = np.unpackbits(np.frombuffer(buf, dtype=np.uint8).reshape(len(texts), nbytes), axis=1, bitorder="little")
+    return bits[:, :len(vocab)].astype(np.float32)
+
+def _category_hits(hits: np.ndarray, vocab: Dict[str, int], lists: List[List[str]]) -> np.ndarray:
+    """(messages, users) bool: does any of user u's keywords occur in message i."""
+    member = np.zeros((len(vocab), len(lists)), dtype=np.float32)
+    always = np.zeros(len(lists), dtype=bool)
+    for u, kws in enumerate(lists):
+        for k in kws:
+            if k: member[vocab[k], u] = 1.0
+            else: always[u] = True
+    return ((hits @ member) > 0) | always
+
+@metrics.stage("rank.batch")
+def rank_messages_for_users(messages: List[Dict], prefs_by_user: Dict[str, Dict], top_n: Optional[int] = None) -> Dict[str, List[Dict]]:
+    """Rank the same messages for many users at once.
+
+    Per-message features (keyword hits over the union of everyone's keywords,
+    the fixed urgent/billing terms and message age) are computed once; each
+    user's score is then a weighted sum over those features, evaluated for all
+    users as matrix operations. Scores and reasons agree with rank_messages
+    for each user; with `top_n`, each list is cut to its best `top_n`."""
+    users = list(prefs_by_user)
+    if not users: return {}
+    groups = messages
+    # Grouped entries are scored per member, then reduced to the best score and
+    # the OR of reasons over each group's contiguous rows.
+    rows = [x for m in groups for x in m.get("members") or [m]]
+    starts = np.cumsum([0] + [len(m.get("members") or [m]) for m in groups[:-1]])
+    messages = rows
+    n = len(messages)
+    senders = [(m.get("from") or "").lower() for m in messages]
+    texts = [f"{(m.get('subject') or '').lower()} {(m.get('snippet') or '').lower()}" for m in messages]
+    lists = {key: [[k.lower() for k in prefs_by_user[u].get(key, [])] for u in users]
+             for key in ("vip_senders", "blocked_senders", "always_keywords", "mute_keywords")}
+    sender_vocab = {k: i for i, k in enumerate(dict.fromkeys(k for key in ("vip_senders", "blocked_senders") for kws in lists[key] for k in kws if k))}
+    text_vocab = {k: i for i, k in enumerate(dict.fromkeys(k for key in ("always_keywords", "mute_keywords") for kws in lists[key] for k in kws if k))}
+    sender_hits = _hit_matrix(senders, list(sender_vocab))
+    text_hits = _hit_matrix(texts, list(text_vocab))
+    fixed = MultiMatcher([URGENT_TERMS, MONEY_TERMS])
+    fixed_masks = np.array([fixed.match(t) for t in texts], dtype=np.uint8).reshape(n, 1)
+    cat_hits = [
+        _category_hits(sender_hits, sender_vocab, lists["vip_senders"]),
+        _category_hits(sender_hits, sender_vocab, lists["blocked_senders"]),
+        _category_hits(text_hits, text_vocab, lists["always_keywords"]),
+        _category_hits(text_hits, text_vocab, lists["mute_keywords"]),
+        np.broadcast_to((fixed_masks & 1) > 0, (n, len(users))),
+        np.broadcast_to((fixed_masks & 2) > 0, (n, len(users))),
+    ]
+    weights = []
+    for u in users:
+        w = DEFAULT_WEIGHTS.copy(); w.update(prefs_by_user[u].get("weights", {}))
+        weights.append(w)
+    now = time.time()
+    ages = [_age_hours(m, now) for m in messages]
+    has_age = np.array([a is not None for a in ages]).reshape(n, 1)
+    age = np.array([a or 0.0 for a in ages], dtype=np.float64).reshape(n, 1)
+
+    # Accumulate in the same order as _score so the floating point sums agree.
+    scores = np.zeros((n, len(users)), dtype=np.float64)
+    codes = np.zeros((n, len(users)), dtype=np.uint8)
+    for (bit, key, _), hit in zip(SENDER_RULES + TEXT_RULES, cat_hits):
+        w = np.array([float(x[key]) for x in weights])
+        scores += np.where(hit, w, 0.0)
+        codes |= np.where(hit, bit, 0).astype(np.uint8)
+    decay = np.array([float(x["recency_decay_per_hour"]) for x in weights])
+    scores += np.where(has_age, age * decay, 0.0)
+    scores += np.array([float(prefs_by_user[u].get("urgency_bias", 0.5)) * 0.5 for u in users])
+    scores = np.round(scores, 3)
+    if not groups: return {email: [] for email in users}
+    if n != len(groups):
+        scores = np.maximum.reduceat(scores, starts, axis=0)
+        codes = np.bitwise_or.reduceat(codes, starts, axis=0)
+    messages = groups; n = len(groups)
+
+    if top_n is not None and 0 < top_n < n:
+        # Everything scoring at least the top_n-th best is a candidate, so ties
+        # at the cut are resolved by message order just like rank_messages.
+        kth = np.take_along_axis(scores, np.argpartition(-scores, top_n - 1, axis=0)[top_n - 1:top_n], axis=0)[0]
+    else:
+        kth = np.full(len(users), -np.inf)
+    out = {}
+    for u, email in enumerate(users):
+        col = scores[:, u]
+        cand = np.nonzero(col >= kth[u])[0]
+        order = cand[np.argsort(-col[cand], kind="stable")]
+        if top_n is not None: order = order[:top_n]
+        out[email] = [_ranked(messages[i], float(col[i]), codes[i, u]) for i in order]
+    return out
@@ -0,0 +1,77 @@
+import os, html, json, hashlib, threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterator, List, Optional
+from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup
+import metrics
+
+TEMPLATE = "digest_email.html"
+# Rendered digests kept in memory, least recently used evicted first.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "512"))
+# Digests with at least this many rows are streamed by the preview endpoints.
+RENDER_STREAM_ROWS = int(os.getenv("RENDER_STREAM_ROWS", "500"))
+
+_FONT = "font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial,sans-serif"
+THEMES = {
+    "light": {"wrapper": _FONT, "cell": "padding:8px;border-bottom:1px solid #eee", "snippet": "color:#555",
+              "reasons": "font-size:12px;color:#777;margin-top:4px", "footer": "color:#888"},
+    "dark": {"wrapper": f"{_FONT};background:#111827;color:#e5e7eb;padding:16px", "cell": "padding:8px;border-bottom:1px solid #374151",
+             "snippet": "color:#9ca3af", "reasons": "font-size:12px;color:#9ca3af;margin-top:4px", "footer": "color:#6b7280"},
+}
+
+_env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates")), autoescape=True)
+# Gmail snippets arrive HTML-entity-encoded (&#39;, &amp;); decode them so autoescaping encodes them exactly once.
+_env.filters["unescape"] = html.unescape
+_source = _env.loader.get_source(_env, TEMPLATE)[0]
+# One compiled template per theme with its style fragments bound as globals, so
+# a render only interpolates message fields.
+_templates = {name: _env.from_string(_source, globals={"s": {k: Markup(v) for k, v in styles.items()}})
+              for name, styles in THEMES.items()}
+
+def _template(theme: str):
+    return _templates.get(theme) or _templates["light"]
+
+def digest_hash(messages: List[Dict]) -> str:
+    """Identifies what a digest renders: message ids are immutable in Gmail, so
+    id, score, reasons and the collapsed message count per row are enough."""
+    rows = [(m.get("id"), m.get("score"), m.get("reasons", []), m.get("count", 1)) for m in messages]
+    return hashlib.blake2b(json.dumps(rows, separators=(",", ":")).encode(), digest_size=16).hexdigest()
+
+class RenderCache:
+    """Thread-safe LRU of rendered digest HTML with hit/miss counters."""
+    def __init__(self, size: int = RENDER_CACHE_SIZE):
+        self.size = size
+        self._items: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key); self.hits += 1
+                return html
+            self.misses += 1
+        html = render()
+        with self._lock:
+            self._items[key] = html
+            while len(self._items) > self.size: self._items.popitem(last=False)
+        return html
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items), "max_size": self.size}
+
+render_cache = RenderCache()
+
+@metrics.stage("render")
+def render_digest(email: str, messages: List[Dict], theme: str = "light", top_n: int = 20) -> str:
+    """The digest HTML for the first `top_n` of `messages`, served from the
+    render cache when `email` last rendered the same rows in the same theme."""
+    shown = messages[:top_n]
+    key = (email, digest_hash(shown), theme, top_n)
+    return render_cache.get_or_render(key, lambda: _template(theme).render(messages=shown, shown=len(shown)))
+
+def stream_digest(messages: List[Dict], theme: str = "light", top_n: Optional[int] = None) -> Iterator[str]:
+    """Render incrementally, yielding HTML chunks as rows are produced, for
+    digests too large to build as one string. Bypasses the cache."""
+    shown = messages if top_n is None else messages[:top_n]
+    return _template(theme).generate(messages=shown, shown=len(shown))
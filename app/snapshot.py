@@ -0,0 +1,86 @@
+import os, time, threading
+from typing import Callable, Dict, Hashable, List, Optional
+
+# Seconds a fetched mailbox snapshot is served without asking Gmail anything.
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL_SECONDS", "60"))
+
+class _Entry:
+    __slots__ = ("messages", "history_id", "at")
+    def __init__(self, messages: List[Dict], history_id: Optional[str]):
+        self.messages = messages; self.history_id = history_id; self.at = time.monotonic()
+
+class _Flight:
+    __slots__ = ("done", "messages", "error")
+    def __init__(self):
+        self.done = threading.Event(); self.messages = None; self.error = None
+
+def current_history_id(service) -> Optional[str]:
+    return service.users().getProfile(userId="me").execute().get("historyId")
+
+def _trim(entry: _Entry, since: Optional[float]) -> List[Dict]:
+    """Drop messages older than `since` from `entry`, replacing (not mutating)
+    its list since callers may still hold the old one. Call under the lock."""
+    expired = lambda m: m.get("ts") is not None and m["ts"] < since
+    if since is not None and any(expired(m) for m in entry.messages):
+        entry.messages = [m for m in entry.messages if not expired(m)]
+    return entry.messages
+
+class SnapshotCache:
+    """Process-wide cache of fetched mailbox windows so every digest endpoint
+    ranks from one fetch.
+
+    Within the TTL a snapshot is returned without touching Gmail. Once stale,
+    the mailbox historyId is checked and the snapshot is reused if nothing
+    changed; otherwise it is refetched. Concurrent callers for the same key
+    wait on a single in-flight fetch instead of each hitting the API."""
+
+    def __init__(self, ttl: float = SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._inflight: Dict[Hashable, _Flight] = {}
+
+    def get(self, key: Hashable, build_service: Callable, fetch: Callable, since: Optional[float] = None) -> List[Dict]:
+        """Return the snapshot for `key`. `build_service()` is only called when
+        Gmail has to be consulted; `fetch(service)` loads the window. The
+        returned list is shared between callers and must not be mutated.
+
+        A snapshot can outlive its window in a quiet mailbox (the historyId
+        doesn't move), so reused snapshots drop messages with "ts" before
+        `since` (epoch seconds)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry.at < self.ttl:
+                return _trim(entry, since)
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error: raise flight.error
+            return flight.messages
+        try:
+            service = build_service()
+            history_id = current_history_id(service)
+            if entry and entry.history_id == history_id:
+                with self._lock:
+                    messages = _trim(entry, since); entry.at = time.monotonic()
+            else:
+                messages = fetch(service)
+                with self._lock:
+                    self._entries[key] = _Entry(messages, history_id)
+            flight.messages = messages
+            return messages
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self, key: Hashable = None):
+        with self._lock:
+            if key is None: self._entries.clear()
+            else: self._entries.pop(key, None)
@@ -0,0 +1,208 @@
+import os, json, uuid, sqlite3, threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from storage import Storage, DIGEST_PAGE_MAX, RETENTION_BATCH_SIZE, digest_pk
+import metrics
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "gmail_digest.db")
+
+# Documents are stored whole as JSON; the scalar fields queries filter and sort
+# on are copied into indexed columns when a document is written.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    pk TEXT NOT NULL,
+    id TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    email TEXT,
+    created_at TEXT,
+    last_seen TEXT,
+    day TEXT,
+    body TEXT NOT NULL,
+    PRIMARY KEY (pk, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS docs_email ON docs (email, created_at);
+CREATE INDEX IF NOT EXISTS docs_created_at ON docs (pk, created_at);
+CREATE INDEX IF NOT EXISTS docs_last_seen ON docs (pk, last_seen);
+CREATE INDEX IF NOT EXISTS docs_day ON docs (pk, day);
+"""
+COLUMNS = ("email", "created_at", "last_seen", "day")
+
+# Statements are fixed strings with ? placeholders so sqlite3's per-connection
+# statement cache prepares each one once.
+READ = "SELECT body, etag FROM docs WHERE pk = ? AND id = ?"
+INSERT = "INSERT INTO docs (pk, id, etag, email, created_at, last_seen, day, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+UPSERT = INSERT + (" ON CONFLICT (pk, id) DO UPDATE SET etag = excluded.etag, email = excluded.email, created_at = excluded.created_at,"
+                   " last_seen = excluded.last_seen, day = excluded.day, body = excluded.body")
+REPLACE = "UPDATE docs SET etag = ?, email = ?, created_at = ?, last_seen = ?, day = ?, body = ? WHERE pk = ? AND id = ?"
+DELETE = "DELETE FROM docs WHERE pk = ? AND id = ?"
+EXPIRED = {f: f"SELECT id, {f} FROM docs WHERE pk = ? AND {f} >= ? AND {f} < ? ORDER BY {f} LIMIT ?" for f in ("created_at", "last_seen", "day")}
+ALLOWLIST = "SELECT email FROM docs WHERE pk = 'user'"
+MESSAGES = "SELECT id, body FROM docs WHERE pk = ? AND id IN (SELECT value FROM json_each(?))"
+PARTITIONS = "SELECT DISTINCT pk FROM docs WHERE pk GLOB 'digest:*' ORDER BY pk"
+MESSAGE_PARTITIONS = "SELECT DISTINCT pk FROM docs WHERE pk GLOB 'msg:*' ORDER BY pk"
+LEGACY_DIGESTS = "SELECT body FROM docs WHERE pk = 'digest' LIMIT ?"
+DIGEST_PAGE = "SELECT body FROM docs WHERE pk = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?"
+DIGESTS_SINCE = "SELECT body FROM docs WHERE pk GLOB 'digest*' AND created_at >= ?"
+ROLLUPS = "SELECT body, etag FROM docs WHERE pk = 'rollup' AND day >= ? AND day <= ?"
+
+def _not_found(item):
+    return exceptions.CosmosResourceNotFoundError(status_code=404, message=f"{item} not found")
+
+def _row(body: Dict[str, Any], etag: str) -> tuple:
+    doc = {k: v for k, v in body.items() if not k.startswith("_")}
+    return (doc["pk"], doc["id"], etag, *(doc.get(c) for c in COLUMNS), json.dumps(doc, separators=(",", ":")))
+
+def _doc(body: str, etag: str) -> Dict[str, Any]:
+    doc = json.loads(body); doc["_etag"] = etag
+    return doc
+
+class _SqliteContainer:
+    """The Cosmos ContainerProxy point operations Storage uses, over one SQLite
+    table. File databases run in WAL mode with a connection per thread, so
+    readers never wait on the writer; an in-memory database is a single
+    connection shared under a lock."""
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._shared = self._connect() if path == ":memory:" else None
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=self.path != ":memory:")
+        if self.path != ":memory:":
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @contextmanager
+    def connection(self):
+        if self._shared is not None:
+            with self._lock: yield self._shared
+            return
+        db = getattr(self._local, "db", None)
+        if db is None: db = self._local.db = self._connect()
+        yield db
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK"); raise
+            db.execute("COMMIT")
+
+    def read_item(self, item, partition_key):
+        with self.connection() as db:
+            found = db.execute(READ, (partition_key, item)).fetchone()
+        if found is None: raise _not_found(item)
+        return _doc(*found)
+    def create_item(self, body):
+        etag = uuid.uuid4().hex
+        try:
+            with self.connection() as db: db.execute(INSERT, _row(body, etag))
+        except sqlite3.IntegrityError:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message=f"{body['id']} exists")
+        return {**body, "_etag": etag}
+    def upsert_item(self, body):
+        etag = uuid.uuid4().hex
+        with self.connection() as db: db.execute(UPSERT, _row(body, etag))
+        return {**body, "_etag": etag}
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        new_etag = uuid.uuid4().hex
+        pk, _, _, *fields = _row(body, new_etag)
+        q, args = REPLACE, (new_etag, *fields, pk, item)
+        if match_condition == MatchConditions.IfNotModified:
+            q, args = REPLACE + " AND etag = ?", args + (etag,)
+        with self.connection() as db:
+            if db.execute(q, args).rowcount: return {**body, "_etag": new_etag}
+            exists = db.execute(READ, (pk, item)).fetchone()
+        if exists is None: raise _not_found(item)
+        raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+    def patch_item(self, item, partition_key, patch_operations):
+        with self.transaction() as db:
+            found = db.execute(READ, (partition_key, item)).fetchone()
+            if found is None: raise _not_found(item)
+            body = json.loads(found[0])
+            for op in patch_operations:
+                if op["op"] != "set": raise NotImplementedError(op["op"])
+                body[op["path"].lstrip("/")] = op["value"]
+            etag = uuid.uuid4().hex
+            db.execute(UPSERT, _row(body, etag))
+        return {**body, "_etag": etag}
+    def delete_item(self, item, partition_key):
+        with self.connection() as db:
+            if not db.execute(DELETE, (partition_key, item)).rowcount: raise _not_found(item)
+
+class SqliteStorage(Storage):
+    """Storage on a local SQLite database (":memory:" for an in-process one),
+    for development, single-node deployments and load tests. Batches are
+    single transactions through executemany. Document "ttl" fields are
+    ignored; expiry is left to the retention job in both retention modes."""
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__(_SqliteContainer(path))
+
+    def get_allowlist(self) -> List[str]:
+        with self.container.connection() as db:
+            return [x[0] for x in db.execute(ALLOWLIST)]
+
+    def _upsert_batch(self, pk: str, docs: List[Dict[str, Any]]):
+        with self.container.transaction() as db:
+            db.executemany(UPSERT, [_row(d, uuid.uuid4().hex) for d in docs])
+    def _load_messages(self, pk: str, keys: List[str]) -> Dict[str, Dict]:
+        with self.container.connection() as db:
+            rows = db.execute(MESSAGES, (pk, json.dumps(keys))).fetchall()
+        return {i: json.loads(body)["m"] for i, body in rows}
+    def _expired(self, pk: str, field: str, cutoff: str, after: str, limit: int) -> List[Dict[str, Any]]:
+        with self.container.connection() as db:
+            return [{"id": i, "at": at} for i, at in db.execute(EXPIRED[field], (pk, after, cutoff, limit))]
+    def _delete_batch(self, pk: str, ids: List[str]) -> int:
+        with self.container.transaction() as db:
+            return db.executemany(DELETE, [(pk, i) for i in ids]).rowcount
+
+    def _digest_partitions(self) -> List[str]:
+        with self.container.connection() as db:
+            return [x[0] for x in db.execute(PARTITIONS)]
+    def _message_partitions(self) -> List[str]:
+        with self.container.connection() as db:
+            return [x[0] for x in db.execute(MESSAGE_PARTITIONS)]
+
+    def migrate_digest_partitions(self, progress=None) -> int:
+        moved = 0
+        while True:
+            with self.container.transaction() as db:
+                page = [json.loads(x[0]) for x in db.execute(LEGACY_DIGESTS, (RETENTION_BATCH_SIZE,))]
+                db.executemany(UPSERT, [_row({**d, "pk": digest_pk(d["email"])}, uuid.uuid4().hex) for d in page])
+                db.executemany(DELETE, [("digest", d["id"]) for d in page])
+            if not page: return moved
+            moved += len(page)
+            if progress: progress(migrated=moved)
+
+    def get_digest_page(self, email: str, limit: int = 20, continuation: Optional[str] = None) -> (List[Dict[str, Any]], Optional[str]):
+        # Keyset pagination: the token is the (created_at, id) of the last row served.
+        limit = max(1, min(DIGEST_PAGE_MAX, limit))
+        try:
+            created_at, doc_id = json.loads(continuation) if continuation else ("\uffff", "")
+            if not (isinstance(created_at, str) and isinstance(doc_id, str)): raise TypeError
+        except (TypeError, ValueError):
+            raise ValueError("invalid continuation token")
+        with self.container.connection() as db:
+            docs = [json.loads(x[0]) for x in db.execute(DIGEST_PAGE, (digest_pk(email), created_at, doc_id, limit + 1))]
+        token = json.dumps([docs[limit - 1]["created_at"], docs[limit - 1]["id"]]) if len(docs) > limit else None
+        return self._expand_digests(docs[:limit]), token
+
+    def get_digests_since(self, cutoff_iso: str):
+        with self.container.connection() as db:
+            docs = [json.loads(x[0]) for x in db.execute(DIGESTS_SINCE, (cutoff_iso,))]
+        return self._expand_digests(docs)
+
+    def get_rollups(self, start_day: str, end_day: str) -> List[Dict[str, Any]]:
+        with self.container.connection() as db:
+            return [_doc(*x) for x in db.execute(ROLLUPS, (start_day, end_day))]
+
+metrics.instrument(SqliteStorage, "storage")
@@ -1,12 +1,54 @@
-import os, json, time
-from typing import Dict, Any, List
+import os, json, time, copy, zlib, base64, logging, threading
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from ranking import encode_reasons, decode_reasons
+import metrics
+from tokens import encrypt_token, decrypt_token
+
+logger = logging.getLogger(__name__)
 
 COSMOS_URL = os.getenv("COSMOS_URL")
 COSMOS_KEY = os.getenv("COSMOS_KEY")
 COSMOS_DB = os.getenv("COSMOS_DB", "GmailDigest")
 COSMOS_CONTAINER = os.getenv("COSMOS_CONTAINER", "Data")
+# "cosmos", "sqlite" (a local file, see sqlite_storage.SQLITE_PATH) or "memory"
+# (SQLite in memory, for tests and benchmarks). Local backends must be chosen
+# explicitly so a deployment missing COSMOS_URL fails instead of writing to local disk.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cosmos")
+# Seconds a user's combined allowlist/admin/prefs record is served from memory.
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))
+# "delete": the retention job deletes expired digests in batches. "ttl": digests
+# are written with a document TTL and Cosmos expires them itself; the job then
+# only sweeps older documents written without one.
+RETENTION_MODE = os.getenv("RETENTION_MODE", "delete")
+RETENTION_BATCH_SIZE = 100  # Cosmos transactional batch limit
+RETENTION_RU_PER_SECOND = float(os.getenv("RETENTION_RU_PER_SECOND", "200"))
+# Scheduled runs create one job per shard per hour; their records are kept this long.
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "14"))
+
+# zlib+base64 the digest reference list; trades a little CPU for smaller documents and RU.
+DIGEST_COMPRESS = os.getenv("DIGEST_COMPRESS", "0") == "1"
+MESSAGE_FIELDS = ("id", "threadId", "subject", "from", "to", "date", "snippet", "labels", "historyId", "internalDate", "ts")
+MESSAGE_TOUCH_SECONDS = 86400
+
+# Index the scalar fields queries filter and sort on (created_at, day, last_seen,
+# email, ...) but not the bulky payloads, which only make writes cost more RU.
+INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/*"}, {"path": "/created_at/?"}],
+    "excludedPaths": [{"path": f"/{p}/*"} for p in ("data", "items", "z", "m", "messages", "prefs", "params", "progress", "result", "score_hist", "reasons", "ranked", "html", "token")]
+                     + [{"path": '/"_etag"/?'}],
+}
+DIGEST_PAGE_MAX = 50
+
+def digest_pk(email: str) -> str:
+    """Digests are partitioned per user so history reads hit one partition."""
+    return f"digest:{email}"
 
 DEFAULT_PREFS = {
     "vip_senders": [],
@@ -14,69 +56,511 @@ DEFAULT_PREFS = {
     "always_keywords": [],
     "mute_keywords": [],
     "urgency_bias": 0.5,
-    "weights": {}, "email_theme":"light", "top_n":20, "min_score":0.0, "importance_threshold":0.5, "email_theme":"light", "top_n":20
+    "weights": {}, "email_theme":"light", "top_n":20, "min_score":0.0, "importance_threshold":0.5, "email_theme":"light", "top_n":20,
+    "delivery_hours": [5, 12, 16],  # local (TZ) hours the scheduled digest is emailed at
 }
 
-class Storage:
-    def __init__(self):
-        self.client = CosmosClient(COSMOS_URL, COSMOS_KEY) if COSMOS_URL and COSMOS_KEY else None
-        if self.client:
-            self.db = self.client.create_database_if_not_exists(id=COSMOS_DB)
-            self.container = self.db.create_container_if_not_exists(id=COSMOS_CONTAINER, partition_key=PartitionKey(path="/pk"))
-        else:
-            raise RuntimeError("Cosmos DB env not configured")
+def message_key(mailbox: Optional[str], msg_id: str) -> str:
+    """Document id for a message's metadata. Gmail ids are only unique within
+    a mailbox; digests saved before mailboxes were recorded reference msg:{id}."""
+    return f"msg:{mailbox}:{msg_id}" if mailbox else f"msg:{msg_id}"
+
+def message_pk(mailbox: Optional[str]) -> str:
+    """Partition for a mailbox's message documents. Older documents all sit in
+    the single "msg" partition and are still read (and swept) there."""
+    return f"msg:{mailbox}" if mailbox else "msg"
+
+class TTLCache:
+    """Thread-safe read-through cache with a fixed TTL and hit/miss counters."""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._items: Dict[Any, tuple] = {}
+        self._lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            hit = self._items.get(key)
+            if hit and hit[0] > now:
+                self.hits += 1
+                return hit[1]
+            self.misses += 1
+        value = loader()
+        with self._lock:
+            self._items[key] = (now + self.ttl, value)
+        return value
+    def invalidate(self, key):
+        with self._lock: self._items.pop(key, None)
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items), "ttl_seconds": self.ttl}
+
+class _Uncacheable(Exception):
+    """Raised inside a cache loader when the read failed transiently; the
+    caller falls back to the old not-found defaults without caching them."""
+
+class Storage(ABC):
+    """Backend-independent store. The shared logic (user record caching,
+    digest packing, rollups, paced retention) talks to `self.container`,
+    which offers the subset of the Cosmos ContainerProxy point-operation API
+    used here and raises the azure.cosmos exception types. A backend supplies
+    that container and implements the abstract query methods at the bottom of this class.
+    Construct through get_storage()."""
+    def __init__(self, container):
+        self.container = container
+        self._init_caches()
+
+    def _init_caches(self):
+        self.user_cache = TTLCache(USER_CACHE_TTL)
+        self.token_cache = TTLCache(USER_CACHE_TTL)
+        self._message_seen: Dict[str, float] = {}
 
     # --- Allowlist & Admins ---
     def bootstrap_admin(self, admin_email: str):
         if not admin_email: return
         if not self.is_allowed(admin_email):
             self.container.upsert_item({"id": f"user:{admin_email}", "pk":"user", "email": admin_email, "role":"admin"})
-    def is_admin(self, email: str) -> bool:
+            self.user_cache.invalidate(admin_email)
+    def get_user_record(self, email: str) -> Dict[str, Any]:
+        """{"allowed", "admin", "prefs"} for `email`, normally from one point read
+        of the user document (prefs are mirrored into it) and cached for
+        USER_CACHE_TTL seconds. Treat the result as read-only."""
+        try:
+            return self.user_cache.get_or_load(email, lambda: self._load_user_record(email))
+        except _Uncacheable:
+            return {"allowed": False, "admin": False, "prefs": DEFAULT_PREFS.copy()}
+    def _load_user_record(self, email: str) -> Dict[str, Any]:
         try:
             item = self.container.read_item(item=f"user:{email}", partition_key="user")
-            return item.get("role") == "admin"
+        except exceptions.CosmosResourceNotFoundError:
+            return {"allowed": False, "admin": False, "prefs": self._read_prefs(email)}
         except exceptions.CosmosHttpResponseError:
-            return False
+            raise _Uncacheable()
+        prefs = item.get("prefs")
+        if prefs is None:
+            # Older user documents don't carry prefs yet; copy them over once.
+            prefs = self._read_prefs(email)
+            self._mirror_prefs(email, prefs)
+        return {"allowed": True, "admin": item.get("role") == "admin", "prefs": prefs}
+    def is_admin(self, email: str) -> bool:
+        return self.get_user_record(email)["admin"]
     def is_allowed(self, email: str) -> bool:
-        try:
-            self.container.read_item(item=f"user:{email}", partition_key="user")
-            return True
-        except exceptions.CosmosHttpResponseError:
-            return False
-    def get_allowlist(self) -> List[str]:
-        q = "SELECT c.email FROM c WHERE c.pk='user'"
-        return [x["email"] for x in self.container.query_items(q, enable_cross_partition_query=True)]
+        return self.get_user_record(email)["allowed"]
     def add_allowed(self, email: str):
         self.container.upsert_item({"id": f"user:{email}", "pk":"user", "email": email, "role":"user"})
+        self.user_cache.invalidate(email)
     def remove_allowed(self, email: str):
         try: self.container.delete_item(item=f"user:{email}", partition_key="user")
         except exceptions.CosmosHttpResponseError: pass
+        self.delete_gmail_token(email)
+        self.user_cache.invalidate(email)
 
     # --- Prefs ---
-    def get_prefs(self, email: str) -> Dict[str, Any]:
+    def _read_prefs(self, email: str) -> Dict[str, Any]:
         try:
             item = self.container.read_item(item=f"prefs:{email}", partition_key="prefs")
             return item.get("data", DEFAULT_PREFS.copy())
-        except exceptions.CosmosHttpResponseError:
+        except exceptions.CosmosResourceNotFoundError:
             return DEFAULT_PREFS.copy()
+        except exceptions.CosmosHttpResponseError:
+            raise _Uncacheable()
+    def _mirror_prefs(self, email: str, data: Dict[str, Any]):
+        try:
+            self.container.patch_item(item=f"user:{email}", partition_key="user", patch_operations=[{"op": "set", "path": "/prefs", "value": data}])
+        except exceptions.CosmosHttpResponseError:
+            pass
+    def get_prefs(self, email: str) -> Dict[str, Any]:
+        return copy.deepcopy(self.get_user_record(email)["prefs"])
     def save_prefs(self, email: str, data: Dict[str, Any]):
         self.container.upsert_item({"id": f"prefs:{email}", "pk":"prefs", "email": email, "data": data})
+        self._mirror_prefs(email, data)
+        self.user_cache.invalidate(email)
+
+    # --- Gmail tokens ---
+    # Refresh tokens granted at login, Fernet-encrypted (TOKEN_ENCRYPTION_KEY).
+    def save_gmail_token(self, email: str, refresh_token: str):
+        self.container.upsert_item({"id": f"token:{email}", "pk": "token", "email": email,
+                                    "token": encrypt_token(refresh_token), "updated_at": datetime.utcnow().isoformat()})
+        self.token_cache.invalidate(email)
+    def get_gmail_token(self, email: str) -> Optional[str]:
+        """`email`'s own refresh token, or None if they have none (or it can't
+        be decrypted). Cached like user records. A transient read error raises
+        rather than quietly switching the user to the shared mailbox."""
+        return self.token_cache.get_or_load(email, lambda: self._load_gmail_token(email))
+    def _load_gmail_token(self, email: str) -> Optional[str]:
+        try:
+            item = self.container.read_item(item=f"token:{email}", partition_key="token")
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        token = decrypt_token(item["token"])
+        if token is None: logger.warning("Stored Gmail token for %s cannot be decrypted with the configured keys", email)
+        return token
+    def delete_gmail_token(self, email: str):
+        try: self.container.delete_item(item=f"token:{email}", partition_key="token")
+        except exceptions.CosmosHttpResponseError: pass
+        self.token_cache.invalidate(email)
+
+    # --- Gmail sync state ---
+    def get_sync_state(self, mailbox: str, window_days: int) -> Optional[Dict[str, Any]]:
+        try:
+            return self.container.read_item(item=f"sync:{mailbox}:{window_days}", partition_key="sync")
+        except exceptions.CosmosHttpResponseError:
+            return None
+    def save_sync_state(self, mailbox: str, window_days: int, history_id: str, messages: List[Dict]):
+        self.container.upsert_item({"id": f"sync:{mailbox}:{window_days}", "pk":"sync", "mailbox": mailbox, "window_days": window_days,
+                                    "history_id": history_id, "updated_at": datetime.utcnow().isoformat(), "messages": messages})
+
+    # --- Jobs ---
+    def create_job(self, run_id: str, params: Dict[str, Any]) -> (Dict[str, Any], bool):
+        """Create the job for `run_id` unless it exists. Returns (job, created)."""
+        ts = datetime.utcnow().isoformat()
+        item = {"id": f"job:{run_id}", "pk":"job", "run_id": run_id, "status":"queued", "params": params,
+                "progress": {}, "result": None, "error": None, "created_at": ts, "updated_at": ts}
+        try:
+            return self.container.create_item(item), True
+        except exceptions.CosmosResourceExistsError:
+            return self.get_job(run_id), False
+    def get_job(self, run_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return self.container.read_item(item=f"job:{run_id}", partition_key="job")
+        except exceptions.CosmosHttpResponseError:
+            return None
+    def update_job(self, job: Dict[str, Any], **fields) -> Optional[Dict[str, Any]]:
+        """Write `fields` onto `job` only if nobody changed it since it was read.
+        Returns the stored job, or None if another writer got there first."""
+        body = {k: v for k, v in job.items() if not k.startswith("_")}
+        body.update(fields, updated_at=datetime.utcnow().isoformat())
+        try:
+            return self.container.replace_item(item=job["id"], body=body, etag=job.get("_etag"), match_condition=MatchConditions.IfNotModified)
+        except exceptions.CosmosAccessConditionFailedError:
+            return None
 
     # --- Digests ---
-    def save_digest(self, email: str, messages: List[Dict]):
+    # Digests hold [message id, score, reason code] references; message metadata
+    # is stored once per Gmail message under msg:{mailbox}:{id}, in that mailbox's
+    # msg:{mailbox} partition, and joined back on read.
+    def _touch_messages(self, mailbox: str, messages: List[Dict]):
+        """Upsert message documents not written (or re-touched) by this process
+        in the last MESSAGE_TOUCH_SECONDS. last_seen drives their retention."""
+        now = time.time()
+        stale = [m for m in messages if now - self._message_seen.get(message_key(mailbox, m["id"]), 0) > MESSAGE_TOUCH_SECONDS]
+        if not stale: return
+        ts = datetime.utcnow().isoformat()
+        pk = message_pk(mailbox)
+        docs = [{"id": message_key(mailbox, m["id"]), "pk": pk, "last_seen": ts, "m": {k: m.get(k) for k in MESSAGE_FIELDS}} for m in stale]
+        if RETENTION_MODE == "ttl":
+            for d in docs: d["ttl"] = (RETENTION_DAYS + 2) * 86400
+        for i in range(0, len(docs), RETENTION_BATCH_SIZE):
+            self._upsert_batch(pk, docs[i:i+RETENTION_BATCH_SIZE])
+        if len(self._message_seen) > 50000: self._message_seen.clear()
+        for d in docs: self._message_seen[d["id"]] = now
+    def save_digest(self, email: str, messages: List[Dict], mailbox: str = "me"):
+        """Record a digest of `messages` from `mailbox` (the shared "me" or the
+        user's own, see app.mailbox_for)."""
+        self._touch_messages(mailbox, messages)
         ts = datetime.utcnow().isoformat()
-        self.container.upsert_item({"id": f"digest:{email}:{ts}", "pk":"digest", "email": email, "created_at": ts, "data": messages})
+        refs = [[m["id"], m.get("score", 0), encode_reasons(m.get("reasons", []))] for m in messages]
+        item = {"id": f"digest:{email}:{ts}", "pk": digest_pk(email), "email": email, "mailbox": mailbox, "created_at": ts, "v": 2}
+        if DIGEST_COMPRESS:
+            item["z"] = base64.b64encode(zlib.compress(json.dumps(refs, separators=(",", ":")).encode())).decode()
+        else:
+            item["items"] = refs
+        if RETENTION_MODE == "ttl": item["ttl"] = RETENTION_DAYS * 86400
+        self.container.upsert_item(item)
+        try:
+            self._update_rollup(email, ts[:10], messages)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning("Rollup update failed for %s: %s", email, e)
+
+    # --- Latest digest ---
+    # One latest:{email} document per user with the most recent ranked window
+    # and its pre-rendered HTML, so page loads don't rerun the pipeline.
+    def get_latest(self, email: str) -> Optional[Dict[str, Any]]:
+        try:
+            return self.container.read_item(item=f"latest:{email}", partition_key="latest")
+        except exceptions.CosmosHttpResponseError:
+            return None
+    def save_latest(self, email: str, doc: Dict[str, Any]):
+        self.container.upsert_item({**doc, "id": f"latest:{email}", "pk": "latest", "email": email, "created_at": datetime.utcnow().isoformat()})
+
+    # --- Analytics rollups ---
+    # One rollup:{email}:{day} document per user per day, maintained as digests
+    # are saved, so analytics never has to read digest history.
+    def _update_rollup(self, email: str, day: str, messages: List[Dict]):
+        doc_id = f"rollup:{email}:{day}"
+        for _ in range(5):
+            try:
+                doc = self.container.read_item(item=doc_id, partition_key="rollup"); new = False
+            except exceptions.CosmosResourceNotFoundError:
+                doc = {"id": doc_id, "pk": "rollup", "email": email, "day": day, "digests": 0, "messages": 0,
+                       "score_sum": 0.0, "score_hist": {}, "reasons": {}}; new = True
+            doc["digests"] += 1
+            doc["messages"] += len(messages)
+            for m in messages:
+                score = float(m.get("score", 0))
+                doc["score_sum"] += score
+                bucket = str(max(-10, min(10, int(score // 1))))
+                doc["score_hist"][bucket] = doc["score_hist"].get(bucket, 0) + 1
+                for r in m.get("reasons", []):
+                    doc["reasons"][r] = doc["reasons"].get(r, 0) + 1
+            try:
+                if new:
+                    self.container.create_item(doc)
+                else:
+                    self.container.replace_item(item=doc_id, body=doc, etag=doc["_etag"], match_condition=MatchConditions.IfNotModified)
+                return
+            except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+                continue  # lost a race with a concurrent save; reread and reapply
+        logger.warning("Gave up updating rollup %s after repeated conflicts", doc_id)
+
+    def _expand_digests(self, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Turn stored digest documents back into {id, email, created_at, data}
+        with full ranked messages. Pre-v2 documents already carry `data`."""
+        refs = {}
+        for d in docs:
+            if "data" in d: continue
+            refs[d["id"]] = json.loads(zlib.decompress(base64.b64decode(d["z"]))) if d.get("z") else d.get("items", [])
+        mailboxes = {d["id"]: d.get("mailbox") for d in docs}
+        keys: Dict[str, set] = {}
+        for k, rs in refs.items():
+            keys.setdefault(message_pk(mailboxes[k]), set()).update(message_key(mailboxes[k], r[0]) for r in rs)
+        messages = {}
+        for pk, ids in keys.items(): messages.update(self._load_messages(pk, list(ids)))
+        # Documents written before messages were partitioned by mailbox are in "msg".
+        legacy = [i for ids in keys.values() for i in ids if i not in messages]
+        if legacy: messages.update(self._load_messages("msg", legacy))
+        out = []
+        for d in docs:
+            data = d.get("data")
+            if data is None:
+                # References to messages already swept by retention are dropped.
+                keyed = ((messages.get(message_key(d.get("mailbox"), i)), score, code) for i, score, code in refs[d["id"]])
+                data = [{**m, "score": score, "reasons": decode_reasons(code)} for m, score, code in keyed if m is not None]
+            out.append({"id": d["id"], "email": d["email"], "created_at": d["created_at"], "data": data})
+        return out
 
     # --- Retention ---
-    def cleanup_retention(self, days: int = 180):
-        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
-        q = f"SELECT c.id FROM c WHERE c.pk='digest' AND c.created_at < '{cutoff}'"
-        to_delete = [x["id"] for x in self.container.query_items(q, enable_cross_partition_query=True)]
-        for id_ in to_delete:
-            try: self.container.delete_item(item=id_, partition_key="digest")
-            except exceptions.CosmosHttpResponseError: pass
+    def _sweep(self, pk: str, field: str, cutoff: str, ru_per_second: float, progress=None) -> Dict[str, Any]:
+        try:
+            checkpoint = self.container.read_item(item=f"retention:{pk}", partition_key="retention")
+        except exceptions.CosmosResourceNotFoundError:
+            checkpoint = {"id": f"retention:{pk}", "pk": "retention"}
+        after = (checkpoint.get("after") or "") if checkpoint.get("status") == "running" else ""
+        deleted = 0; charge = 0.0; started = time.monotonic()
+        while True:
+            page = self._expired(pk, field, cutoff, after, RETENTION_BATCH_SIZE)
+            charge += self._request_charge()
+            if not page: break
+            deleted += self._delete_batch(pk, [x["id"] for x in page])
+            charge += self._request_charge()
+            after = page[-1]["at"]
+            checkpoint.update(status="running", cutoff=cutoff, after=after, updated_at=datetime.utcnow().isoformat())
+            self.container.upsert_item(checkpoint)
+            if progress: progress(partition=pk, deleted=deleted, request_charge=round(charge, 2))
+            # Pace against the RU budget: sleep until average consumption is back under it.
+            ahead = charge / ru_per_second - (time.monotonic() - started)
+            if ahead > 0: time.sleep(ahead)
+        checkpoint.update(status="done", cutoff=cutoff, after=None, deleted=deleted, updated_at=datetime.utcnow().isoformat())
+        self.container.upsert_item(checkpoint)
+        return {"deleted": deleted, "request_charge": round(charge, 2), "cutoff": cutoff}
 
+    def cleanup_retention(self, days: int = RETENTION_DAYS, ru_per_second: float = RETENTION_RU_PER_SECOND, progress=None) -> Dict[str, Any]:
+        """Delete digests and analytics rollups older than `days`, message
+        documents no retained digest can reference, and digest job records
+        older than JOB_RETENTION_DAYS. Each partition is swept oldest first, a page and
+        transactional batch at a time, pacing requests to stay under
+        `ru_per_second`. Progress is checkpointed per partition so an
+        interrupted run resumes where it stopped."""
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        # Messages are re-touched at least daily while in use, so anything not
+        # seen for a day past the digest cutoff is unreferenced.
+        msg_cutoff = cutoff - timedelta(seconds=MESSAGE_TOUCH_SECONDS) - timedelta(days=1)
+        result = {"digest": {"deleted": 0, "request_charge": 0.0, "cutoff": cutoff.isoformat()}}
+        for pk in self._digest_partitions():
+            swept = self._sweep(pk, "created_at", cutoff.isoformat(), ru_per_second, progress)
+            result["digest"]["deleted"] += swept["deleted"]; result["digest"]["request_charge"] += swept["request_charge"]
+        result["msg"] = {"deleted": 0, "request_charge": 0.0, "cutoff": msg_cutoff.isoformat()}
+        for pk in ["msg"] + self._message_partitions():
+            swept = self._sweep(pk, "last_seen", msg_cutoff.isoformat(), ru_per_second, progress)
+            result["msg"]["deleted"] += swept["deleted"]; result["msg"]["request_charge"] += swept["request_charge"]
+        result["rollup"] = self._sweep("rollup", "day", cutoff.date().isoformat(), ru_per_second, progress)
+        job_cutoff = datetime.utcnow() - timedelta(days=JOB_RETENTION_DAYS)
+        result["job"] = self._sweep("job", "created_at", job_cutoff.isoformat(), ru_per_second, progress)
+        return result
 
+    # --- Backend queries ---
+    @abstractmethod
+    def get_allowlist(self) -> List[str]:
+        ...
+    @abstractmethod
+    def _load_messages(self, pk: str, keys: List[str]) -> Dict[str, Dict]:
+        """{document id: stored metadata} for the message_key()s in `pk` that still exist."""
+    @abstractmethod
+    def _expired(self, pk: str, field: str, cutoff: str, after: str, limit: int) -> List[Dict[str, Any]]:
+        """Up to `limit` [{"id", "at"}] in `pk` with after <= field < cutoff, oldest first."""
+    def _upsert_batch(self, pk: str, docs: List[Dict[str, Any]]):
+        for d in docs: self.container.upsert_item(d)
+    def _delete_batch(self, pk: str, ids: List[str]) -> int:
+        deleted = 0
+        for i in ids:
+            try:
+                self.container.delete_item(item=i, partition_key=pk); deleted += 1
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+        return deleted
+    def _request_charge(self) -> float:
+        """Request units consumed by the last call; 0 where there is no such cost."""
+        return 0.0
+    @abstractmethod
+    def _digest_partitions(self) -> List[str]:
+        ...
+    @abstractmethod
+    def _message_partitions(self) -> List[str]:
+        """Every per-mailbox msg:{mailbox} partition (not the legacy "msg")."""
+    @abstractmethod
+    def migrate_digest_partitions(self, progress=None) -> int:
+        """Move digests written under the old shared "digest" partition into
+        their per-user partitions. Idempotent; safe to rerun until it returns 0."""
+    @abstractmethod
+    def get_digest_page(self, email: str, limit: int = 20, continuation: Optional[str] = None) -> (List[Dict[str, Any]], Optional[str]):
+        """One page of `email`'s digests, newest first. Returns (digests,
+        continuation token or None when done). Raises ValueError for a
+        malformed `continuation`."""
+    @abstractmethod
     def get_digests_since(self, cutoff_iso: str):
-        q = f"SELECT c.id, c.email, c.created_at, c.data FROM c WHERE c.pk='digest' AND c.created_at >= '{cutoff_iso}'"
+        ...
+    @abstractmethod
+    def get_rollups(self, start_day: str, end_day: str) -> List[Dict[str, Any]]:
+        ...
+
+class CosmosStorage(Storage):
+    """Azure Cosmos DB backend. Construct through get_storage() so the client,
+    its connection pool and the database/container provisioning are shared
+    by the whole process rather than redone per request."""
+    def __init__(self):
+        if not (COSMOS_URL and COSMOS_KEY):
+            raise RuntimeError("Cosmos DB env not configured (set COSMOS_URL/COSMOS_KEY, or STORAGE_BACKEND=sqlite for a local database)")
+        self.client = CosmosClient(COSMOS_URL, COSMOS_KEY, raw_response_hook=_record_cosmos_response)
+        self.db = self.client.create_database_if_not_exists(id=COSMOS_DB)
+        super().__init__(self._provision())
+
+    def _provision(self):
+        settings = {"indexing_policy": INDEXING_POLICY}
+        # -1 turns TTL on without expiring anything that doesn't set its own "ttl".
+        if RETENTION_MODE == "ttl": settings["default_ttl"] = -1
+        container = self.db.create_container_if_not_exists(id=COSMOS_CONTAINER, partition_key=PartitionKey(path="/pk"), **settings)
+        props = container.read()
+        excluded = {x["path"] for x in props.get("indexingPolicy", {}).get("excludedPaths", [])}
+        if not excluded.issuperset(x["path"] for x in INDEXING_POLICY["excludedPaths"]) or (RETENTION_MODE == "ttl" and props.get("defaultTtl") is None):
+            container = self.db.replace_container(container, partition_key=PartitionKey(path="/pk"), **settings)
+        return container
+
+    def get_allowlist(self) -> List[str]:
+        q = "SELECT c.email FROM c WHERE c.pk='user'"
+        return [x["email"] for x in self.container.query_items(q, enable_cross_partition_query=True)]
+
+    def _upsert_batch(self, pk: str, docs: List[Dict[str, Any]]):
+        self.container.execute_item_batch([("upsert", (d,)) for d in docs], partition_key=pk)
+
+    def get_rollups(self, start_day: str, end_day: str) -> List[Dict[str, Any]]:
+        q = "SELECT * FROM c WHERE c.day >= @start AND c.day <= @end"
+        params = [{"name": "@start", "value": start_day}, {"name": "@end", "value": end_day}]
+        return list(self.container.query_items(q, parameters=params, partition_key="rollup"))
+
+    def _load_messages(self, pk: str, keys: List[str]) -> Dict[str, Dict]:
+        found = {}
+        q = "SELECT c.id, c.m FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
+        for i in range(0, len(keys), 256):
+            params = [{"name": "@ids", "value": keys[i:i+256]}]
+            for x in self.container.query_items(q, parameters=params, partition_key=pk):
+                found[x["id"]] = x["m"]
+        return found
+
+    def _expired(self, pk: str, field: str, cutoff: str, after: str, limit: int) -> List[Dict[str, Any]]:
+        q = (f"SELECT TOP @limit c.id, c.{field} AS at FROM c WHERE c.{field} < @cutoff "
+             f"AND c.{field} >= @after ORDER BY c.{field}")
+        params = [{"name": "@limit", "value": limit}, {"name": "@cutoff", "value": cutoff}, {"name": "@after", "value": after}]
+        return list(self.container.query_items(q, parameters=params, partition_key=pk))
+
+    def _delete_batch(self, pk: str, ids: List[str]) -> int:
+        try:
+            self.container.execute_item_batch([("delete", (i,)) for i in ids], partition_key=pk)
+            return len(ids)
+        except exceptions.CosmosBatchOperationError:
+            # A batch is all-or-nothing; one already-gone item fails it, so retry singly.
+            deleted = 0
+            for i in ids:
+                try:
+                    self.container.delete_item(item=i, partition_key=pk); deleted += 1
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+            return deleted
+
+    def _request_charge(self) -> float:
+        return float(self.container.client_connection.last_response_headers.get("x-ms-request-charge", 0) or 0)
+
+    def _digest_partitions(self) -> List[str]:
+        q = "SELECT DISTINCT VALUE c.pk FROM c WHERE STARTSWITH(c.pk, 'digest:')"
+        return list(self.container.query_items(q, enable_cross_partition_query=True))
+
+    def _message_partitions(self) -> List[str]:
+        q = "SELECT DISTINCT VALUE c.pk FROM c WHERE STARTSWITH(c.pk, 'msg:')"
         return list(self.container.query_items(q, enable_cross_partition_query=True))
+
+    def migrate_digest_partitions(self, progress=None) -> int:
+        moved = 0
+        q = "SELECT TOP @limit * FROM c"
+        while True:
+            page = list(self.container.query_items(q, parameters=[{"name": "@limit", "value": RETENTION_BATCH_SIZE}], partition_key="digest"))
+            if not page: return moved
+            for doc in page:
+                body = {k: v for k, v in doc.items() if not k.startswith("_")}
+                body["pk"] = digest_pk(doc["email"])
+                self.container.upsert_item(body)
+                try: self.container.delete_item(item=doc["id"], partition_key="digest")
+                except exceptions.CosmosResourceNotFoundError: pass
+                moved += 1
+            if progress: progress(migrated=moved)
+
+    def get_digest_page(self, email: str, limit: int = 20, continuation: Optional[str] = None) -> (List[Dict[str, Any]], Optional[str]):
+        # Single-partition query; the token is Cosmos's own continuation.
+        limit = max(1, min(DIGEST_PAGE_MAX, limit))
+        q = "SELECT c.id, c.email, c.mailbox, c.created_at, c.data, c.items, c.z FROM c ORDER BY c.created_at DESC"
+        pages = self.container.query_items(q, partition_key=digest_pk(email), max_item_count=limit).by_page(continuation)
+        try:
+            docs = list(next(pages, []))
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 400 and continuation: raise ValueError("invalid continuation token") from e
+            raise
+        return self._expand_digests(docs), pages.continuation_token
+
+    def get_digests_since(self, cutoff_iso: str):
+        q = "SELECT c.id, c.email, c.mailbox, c.created_at, c.data, c.items, c.z FROM c WHERE STARTSWITH(c.pk, 'digest') AND c.created_at >= @cutoff"
+        docs = list(self.container.query_items(q, parameters=[{"name": "@cutoff", "value": cutoff_iso}], enable_cross_partition_query=True))
+        return self._expand_digests(docs)
+
+def _record_cosmos_response(response):
+    """Pipeline hook run for every Cosmos HTTP response, query pages included."""
+    http = response.http_response
+    metrics.inc("cosmos_requests_total", method=http.request.method, status=http.status_code)
+    metrics.inc("cosmos_request_charge_total", float(http.headers.get("x-ms-request-charge") or 0))
+
+metrics.instrument(CosmosStorage, "storage")
+
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+def get_storage() -> Storage:
+    """The process-wide Storage for STORAGE_BACKEND, created (and the Cosmos
+    database/container or SQLite schema provisioned) on first use. Safe to
+    call from any thread."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "cosmos":
+                    _storage = CosmosStorage()
+                else:
+                    from sqlite_storage import SqliteStorage, SQLITE_PATH
+                    _storage = SqliteStorage(":memory:" if STORAGE_BACKEND == "memory" else SQLITE_PATH)
+    return _storage
@@ -0,0 +1,31 @@
+import os
+from typing import Optional
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+# Comma-separated Fernet keys (Fernet.generate_key()). The first encrypts; all
+# are tried on decrypt, so a new key can be prepended and old ones retired later.
+TOKEN_ENCRYPTION_KEYS = [k.strip() for k in os.getenv("TOKEN_ENCRYPTION_KEY", "").split(",") if k.strip()]
+
+_fernet: Optional[MultiFernet] = None
+
+def _cipher() -> MultiFernet:
+    global _fernet
+    if _fernet is None:
+        if not TOKEN_ENCRYPTION_KEYS: raise RuntimeError("TOKEN_ENCRYPTION_KEY not configured")
+        _fernet = MultiFernet([Fernet(k) for k in TOKEN_ENCRYPTION_KEYS])
+    return _fernet
+
+def token_encryption_enabled() -> bool:
+    return bool(TOKEN_ENCRYPTION_KEYS)
+
+def encrypt_token(token: str) -> str:
+    return _cipher().encrypt(token.encode()).decode()
+
+def decrypt_token(blob: str) -> Optional[str]:
+    """The plaintext token, or None if no configured key can decrypt it
+    (including when TOKEN_ENCRYPTION_KEY has been removed since it was saved)."""
+    if not token_encryption_enabled(): return None
+    try:
+        return _cipher().decrypt(blob.encode()).decode()
+    except InvalidToken:
+        return None
@@ -0,0 +1,25 @@
+import itertools, time
+import pytest
+
+_runs = itertools.count()
+
+def _run_digest(client, st, timeout=600):
+    """POST the scheduler trigger and wait for the queued job to finish."""
+    run_id = f"bench-{next(_runs)}"
+    resp = client.post(f"/api/run_digest?run_id={run_id}", headers={"X-API-Key": "bench"}, base_url="https://localhost")
+    assert resp.status_code == 202
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = st.get_job(run_id)
+        if job["status"] in ("done", "failed"): return job
+        time.sleep(0.002)
+    raise TimeoutError(run_id)
+
+@pytest.mark.parametrize("users", [1, 100, 1000])
+def bench_run_digest_webhook(benchmark, digest_app, users):
+    """Trigger to completion: fetch (incremental after the first round), rank,
+    save history and latest digests, render and send for every user."""
+    client, st, sink = digest_app(users)
+    job = benchmark.pedantic(_run_digest, args=(client, st), rounds=5 if users < 1000 else 2, warmup_rounds=1)
+    assert job["status"] == "done" and job["result"]["emailed"] == users
+    assert sink.sent[-1]["to"].endswith("@example.com")
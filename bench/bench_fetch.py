@@ -0,0 +1,11 @@
+from datetime import datetime, timedelta, timezone as dtz
+import pytest
+from gmail_client import fetch_recent_messages
+
+@pytest.mark.parametrize("batch_size", [1, 50])
+def bench_fetch_recent_messages(benchmark, gmail, batch_size):
+    """One list page plus batched metadata gets; batch_size=1 approximates
+    the old one-request-per-message loop."""
+    since = datetime.now(dtz.utc) - timedelta(days=1)
+    msgs = benchmark(fetch_recent_messages, gmail, since, batch_size=batch_size)
+    assert len(msgs) == len(gmail.order)
@@ -0,0 +1,16 @@
+import pytest
+from ranking import rank_messages, rank_messages_for_users, _compile
+from synthetic import generate_prefs
+
+@pytest.mark.parametrize("keywords", [6, 3000])
+def bench_rank_messages(benchmark, normalized, keywords):
+    prefs = generate_prefs(keywords=keywords)
+    _compile.cache_clear()
+    ranked = benchmark(rank_messages, normalized, prefs)
+    assert len(ranked) == len(normalized)
+
+@pytest.mark.parametrize("users", [1, 100])
+def bench_rank_messages_for_users(benchmark, normalized, users):
+    prefs_by_user = {f"user{i}@example.com": generate_prefs(seed=i) for i in range(users)}
+    ranked = benchmark(rank_messages_for_users, normalized, prefs_by_user)
+    assert len(ranked) == users
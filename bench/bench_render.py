@@ -0,0 +1,21 @@
+import pytest
+from mailer import format_html
+from ranking import rank_messages
+from render import render_cache
+from synthetic import generate_prefs
+
+@pytest.fixture
+def ranked(normalized):
+    return rank_messages(normalized, generate_prefs())
+
+@pytest.mark.parametrize("theme", ["light", "dark"])
+def bench_format_html(benchmark, ranked, theme):
+    html = benchmark.pedantic(format_html, args=("me@example.com", ranked, theme, 20),
+                              setup=lambda: render_cache._items.clear(), rounds=200)
+    assert html.count("<tr>") == 20
+    # Snippet entities are decoded before escaping, never double-encoded.
+    assert "I&#39;m" in html and "&amp;#39;" not in html and "&amp;quot;" not in html
+
+def bench_format_html_cached(benchmark, ranked):
+    format_html("me@example.com", ranked, "light", 20)
+    benchmark(format_html, "me@example.com", ranked, "light", 20)
@@ -0,0 +1,49 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("X_API_KEY", "bench")
+
+import pytest
+from synthetic import generate_mailbox, generate_prefs
+from fakes import FakeGmailService, FakeStorage, FakeMailSink
+
+# Injected per-round-trip latency in milliseconds. Gmail defaults to a small
+# delay so batching shows up; the others default to measuring our own overhead.
+GMAIL_LATENCY = float(os.getenv("BENCH_GMAIL_LATENCY_MS", "1")) / 1000
+STORAGE_LATENCY = float(os.getenv("BENCH_STORAGE_LATENCY_MS", "0")) / 1000
+SEND_LATENCY = float(os.getenv("BENCH_SEND_LATENCY_MS", "0")) / 1000
+MAILBOX_SIZE = int(os.getenv("BENCH_MAILBOX_SIZE", "500"))
+
+@pytest.fixture(scope="session")
+def mailbox():
+    return generate_mailbox(MAILBOX_SIZE)
+
+@pytest.fixture
+def gmail(mailbox):
+    return FakeGmailService(mailbox, GMAIL_LATENCY)
+
+@pytest.fixture
+def normalized(mailbox):
+    from gmail_client import _normalize
+    return [_normalize(m) for m in mailbox]
+
+@pytest.fixture
+def digest_app(monkeypatch, mailbox):
+    """The Flask app wired to fakes. Returns a function that seeds `users`
+    allowlisted recipients and gives back (test client, storage, mail sink)."""
+    import app as web, mailer, storage
+    def setup(users: int):
+        st = FakeStorage(STORAGE_LATENCY)
+        for i in range(users):
+            email = f"user{i}@example.com"
+            st.add_allowed(email)
+            st.save_prefs(email, generate_prefs(seed=i))
+        sink = FakeMailSink(SEND_LATENCY)
+        monkeypatch.setattr(storage, "_storage", st)
+        monkeypatch.setattr(mailer, "SENDGRID_API_KEY", "bench")
+        monkeypatch.setattr(mailer, "send_mail", sink.send)
+        monkeypatch.setattr(web, "build_gmail_service", lambda: FakeGmailService(mailbox, GMAIL_LATENCY))
+        web.snapshots.invalidate()
+        return web.app.test_client(), st, sink
+    return setup
@@ -0,0 +1,110 @@
+"""Local stand-ins for Gmail, Storage and SendGrid with injectable latency."""
+import re, time, threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from storage import Storage
+from sqlite_storage import SqliteStorage, _SqliteContainer
+
+def _http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+class _Call:
+    """A prepared request; execute() is one round trip."""
+    def __init__(self, service: "FakeGmailService", fn: Callable):
+        self.service = service; self.fn = fn
+    def execute(self):
+        self.service.round_trip()
+        return self.fn()
+
+class _Batch:
+    def __init__(self, service: "FakeGmailService", callback: Callable):
+        self.service = service; self.callback = callback; self.calls = []
+    def add(self, call: _Call, request_id: str):
+        self.calls.append((request_id, call))
+    def execute(self):
+        self.service.round_trip()
+        for request_id, call in self.calls:
+            try:
+                self.callback(request_id, call.fn(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+class _Messages:
+    def __init__(self, service): self.service = service
+    def list(self, userId, q="", maxResults=100, pageToken=None):
+        return _Call(self.service, lambda: self.service.list_page(q, maxResults, pageToken))
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        return _Call(self.service, lambda: self.service.get_message(id))
+
+class _History:
+    def __init__(self, service): self.service = service
+    def list(self, userId, startHistoryId, pageToken=None, historyTypes=None):
+        # The synthetic mailbox never changes, so there is no history to replay.
+        return _Call(self.service, lambda: {"history": [], "historyId": self.service.history_id})
+
+class _Users:
+    def __init__(self, service): self.service = service
+    def messages(self): return _Messages(self.service)
+    def history(self): return _History(self.service)
+    def getProfile(self, userId):
+        return _Call(self.service, lambda: {"emailAddress": "me@example.com", "historyId": self.service.history_id})
+
+class FakeGmailService:
+    """Just enough of the Gmail discovery client for gmail_client and the
+    snapshot cache, over a fixed list of synthetic messages. Every round trip
+    (a batch counts once) sleeps `latency` seconds."""
+    def __init__(self, messages: List[Dict], latency: float = 0.0):
+        self.by_id = {m["id"]: m for m in messages}
+        self.order = sorted(messages, key=lambda m: int(m["internalDate"]), reverse=True)
+        self.history_id = str(max((int(m["historyId"]) for m in messages), default=1))
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+    def users(self): return _Users(self)
+    def new_batch_http_request(self, callback): return _Batch(self, callback)
+    def round_trip(self):
+        with self._lock: self.round_trips += 1
+        if self.latency: time.sleep(self.latency)
+    def list_page(self, q: str, max_results: int, page_token: str = None) -> Dict:
+        days = int(re.search(r"newer_than:(\d+)d", q).group(1)) if "newer_than:" in q else 36500
+        cutoff = (time.time() - days * 86400) * 1000
+        ids = [m["id"] for m in self.order if int(m["internalDate"]) >= cutoff]
+        start = int(page_token or 0); end = start + max_results
+        page = {"messages": [{"id": i} for i in ids[start:end]], "resultSizeEstimate": len(ids)}
+        if end < len(ids): page["nextPageToken"] = str(end)
+        return page
+    def get_message(self, msg_id: str) -> Dict:
+        if msg_id not in self.by_id: raise _http_error(404)
+        return self.by_id[msg_id]
+
+class _SlowContainer(_SqliteContainer):
+    """Adds `latency` seconds to every SQLite access, as a network round trip would."""
+    def __init__(self, path: str, latency: float):
+        self.latency = latency
+        super().__init__(path)
+    @contextmanager
+    def connection(self):
+        if self.latency: time.sleep(self.latency)
+        with super().connection() as db:
+            yield db
+
+class FakeStorage(SqliteStorage):
+    """In-memory SqliteStorage with injectable per-request latency."""
+    def __init__(self, latency: float = 0.0):
+        Storage.__init__(self, _SlowContainer(":memory:", latency))
+
+class FakeMailSink:
+    """Replaces mailer.send_mail: records what would have been sent."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent: List[Dict] = []
+        self._lock = threading.Lock()
+    def send(self, message):
+        if self.latency: time.sleep(self.latency)
+        body = message.get()
+        with self._lock:
+            self.sent.append({"to": body["personalizations"][0]["to"][0]["email"], "bytes": len(str(body))})
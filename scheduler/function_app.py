@@ -1,17 +1,46 @@
-import os, requests
+import os, time, requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import azure.functions as func
 
 app = func.FunctionApp()
 
-# PT timezone via Function App setting TZ=America/Los_Angeles
-@app.schedule(schedule="0 0 5,12,16 * * *", arg_name="timer")
+# The allowlist is split into this many shards by email hash; each is its own backend job.
+SHARDS = int(os.environ.get("DIGEST_SHARDS", "4"))
+# Delay between shard triggers, spreading a tick's load across the hour (0 = all at once).
+SHARD_STAGGER_SECONDS = float(os.environ.get("DIGEST_SHARD_STAGGER_SECONDS", "0"))
+
+def trigger_shard(base, api_key, run_id, hour, shard):
+    time.sleep(shard * SHARD_STAGGER_SECONDS)
+    try:
+        r = requests.post(f"{base}/api/run_digest", params={"shard": shard, "of": SHARDS, "hour": hour},
+                          headers={"X-API-Key": api_key, "X-Run-Id": run_id}, timeout=30)
+        print(f"Digest shard {shard}/{SHARDS} trigger status:", r.status_code, r.text[:200])
+    except Exception as e:
+        print(f"Error calling backend for shard {shard}/{SHARDS}:", e)
+
+# Hourly; users choose their delivery hours in prefs. PT timezone via Function App setting TZ=America/Los_Angeles
+@app.schedule(schedule="0 0 * * * *", arg_name="timer")
 def run_digest(timer: func.TimerRequest) -> None:
+    base = os.environ.get("BACKEND_BASE_URL")
+    api_key = os.environ.get("X_API_KEY")
+    if not base or not api_key:
+        print("Missing BACKEND_BASE_URL or X_API_KEY"); return
+    # Same run id for retries of this tick, so the backend doesn't rerun shards that finished.
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H")
+    hour = datetime.now().hour
+    with ThreadPoolExecutor(max_workers=SHARDS) as pool:
+        for shard in range(SHARDS):
+            pool.submit(trigger_shard, base, api_key, run_id, hour, shard)
+
+@app.schedule(schedule="0 30 2 * * *", arg_name="timer")
+def run_retention(timer: func.TimerRequest) -> None:
     base = os.environ.get("BACKEND_BASE_URL")
     api_key = os.environ.get("X_API_KEY")
     if not base or not api_key:
         print("Missing BACKEND_BASE_URL or X_API_KEY"); return
     try:
-        r = requests.post(f"{base}/api/run_digest", headers={"X-API-Key": api_key}, timeout=30)
-        print("Digest trigger status:", r.status_code, r.text[:200])
+        r = requests.post(f"{base}/api/run_retention", headers={"X-API-Key": api_key}, timeout=30)
+        print("Retention trigger status:", r.status_code, r.text[:200])
     except Exception as e:
         print("Error calling backend:", e)
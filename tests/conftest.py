@@ -0,0 +1,23 @@
+import os, sys, uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import pytest
+
+BACKENDS = ["sqlite-memory", "sqlite-file", "cosmos"]
+
+@pytest.fixture(params=BACKENDS)
+def st(request, tmp_path, monkeypatch):
+    """A fresh, empty Storage per test on each backend. Cosmos runs only when
+    COSMOS_URL/COSMOS_KEY are set, in a throwaway container that is dropped afterwards."""
+    import storage
+    if request.param == "cosmos":
+        if not (storage.COSMOS_URL and storage.COSMOS_KEY): pytest.skip("COSMOS_URL/COSMOS_KEY not set")
+        monkeypatch.setattr(storage, "COSMOS_CONTAINER", f"conformance-{uuid.uuid4().hex[:12]}")
+        backend = storage.CosmosStorage()
+        yield backend
+        backend.db.delete_container(storage.COSMOS_CONTAINER)
+        return
+    from sqlite_storage import SqliteStorage
+    yield SqliteStorage(":memory:" if request.param == "sqlite-memory" else str(tmp_path / "digest.db"))
@@ -0,0 +1,42 @@
+import json
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+import gmail_client
+
+def http_error(status, reason=None):
+    content = json.dumps({"error": {"code": status, "errors": [{"reason": reason}] if reason else []}}).encode()
+    return HttpError(httplib2.Response({"status": status}), content)
+
+class FakeService:
+    """Batches whose sub-requests fail with `errors[id]` (one per attempt) before succeeding."""
+    def __init__(self, errors):
+        self.errors = errors; self.attempts = 0
+    def new_batch_http_request(self, callback):
+        service = self
+        class Batch:
+            def __init__(self): self.ids = []
+            def add(self, request, request_id): self.ids.append(request_id)
+            def execute(self):
+                service.attempts += 1
+                for i in self.ids:
+                    queued = service.errors.get(i) or []
+                    if queued: callback(i, None, queued.pop(0))
+                    else: callback(i, {"id": i}, None)
+        return Batch()
+
+@pytest.fixture(autouse=True)
+def no_requests(monkeypatch):
+    monkeypatch.setattr(gmail_client, "_get_request", lambda service, msg_id: None)
+    monkeypatch.setattr(gmail_client, "_backoff", lambda attempt: None)
+
+@pytest.mark.parametrize("reason", ["rateLimitExceeded", "userRateLimitExceeded"])
+def test_rate_limited_403s_are_retried(reason):
+    service = FakeService({"2": [http_error(403, reason), http_error(429)]})
+    assert gmail_client._fetch_chunk(service, ["1", "2"]) == {"1": {"id": "1"}, "2": {"id": "2"}}
+    assert service.attempts == 3
+
+@pytest.mark.parametrize("error", [http_error(403, "insufficientPermissions"), http_error(403), HttpError(httplib2.Response({"status": 403}), b"<html>")])
+def test_other_403s_are_not_retried(error):
+    with pytest.raises(HttpError):
+        gmail_client._fetch_chunk(FakeService({"1": [error]}), ["1"])
@@ -0,0 +1,48 @@
+import pytest
+import ranking
+from grouping import group_messages
+from ranking import rank_messages, rank_messages_for_users
+
+NOW = 1_800_000_000.0
+PREFS = {"vip_senders": ["boss@corp.example"], "urgency_bias": 0.5}
+
+def message(i, thread, sender, subject, snippet, hours_ago, labels=("INBOX",)):
+    return {"id": str(i), "threadId": thread, "from": sender, "subject": subject, "snippet": snippet,
+            "labels": list(labels), "ts": NOW - hours_ago * 3600}
+
+@pytest.fixture(autouse=True)
+def fixed_clock(monkeypatch):
+    monkeypatch.setattr(ranking.time, "time", lambda: NOW)
+
+def vip_thread():
+    return [
+        message(1, "t1", "Boss <boss@corp.example>", "Invoice overdue – urgent", "Please pay the invoice today", 5),
+        message(2, "t1", "Me <me@example.com>", "Re: Invoice overdue – urgent", "On it", 1, labels=("SENT",)),
+        message(3, "t2", "News <news@list.example>", "Weekly roundup", "Stories this week", 2),
+    ]
+
+def test_thread_is_scored_on_all_members():
+    # The user's reply is the newest message, but the VIP's mail still carries the thread.
+    msgs = vip_thread()
+    alone = {m["id"]: m for m in rank_messages(msgs, PREFS)}
+    grouped = rank_messages(group_messages(msgs, near_duplicates=False), PREFS)
+    thread = next(m for m in grouped if m["threadId"] == "t1")
+    assert thread["count"] == 2 and thread["message_ids"] == ["2", "1"]
+    assert thread["score"] == max(alone["1"]["score"], alone["2"]["score"]) == alone["1"]["score"]
+    assert thread["reasons"] == ["VIP", "Deadline/Urgent", "Billing/Invoice"]
+    assert thread["snippet"] == "On it"  # latest snippet for display
+    assert thread["from"] == "Boss <boss@corp.example>"  # not the user's own reply
+    assert "members" not in thread and grouped[0] is thread
+
+def test_batch_ranking_scores_groups_like_rank_messages():
+    grouped = group_messages(vip_thread(), near_duplicates=False)
+    prefs_by_user = {"a": PREFS, "b": {"always_keywords": ["roundup"]}}
+    batch = rank_messages_for_users(grouped, prefs_by_user)
+    for user, prefs in prefs_by_user.items():
+        assert batch[user] == rank_messages(grouped, prefs)
+
+def test_near_duplicates_collapse_into_newest():
+    msgs = [message(1, "a", "shop@shop.example", "Order 1234 shipped", "Your order 1234 is on its way", 3),
+            message(2, "b", "shop@shop.example", "Order 98765 shipped", "Your order 98765 is on its way", 1)]
+    grouped = group_messages(msgs)
+    assert len(grouped) == 1 and grouped[0]["count"] == 2 and grouped[0]["id"] == "2"
@@ -0,0 +1,49 @@
+import json, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import app as web
+import mailer
+from sqlite_storage import SqliteStorage
+
+class SendGridStub(BaseHTTPRequestHandler):
+    """Stands in for the SendGrid API: slow@x is answered after a delay longer
+    than the client timeout, down@x always gets a 503, anyone else a 202."""
+    calls = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        to = body["personalizations"][0]["to"][0]["email"]
+        self.calls.append(to)
+        if to == "slow@x": threading.Event().wait(1.0)
+        status = 503 if to == "down@x" else 202
+        self.send_response(status); self.send_header("Content-Length", "0"); self.end_headers()
+
+    def log_message(self, *args): pass
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SendGridStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    SendGridStub.calls = []
+    monkeypatch.setattr(mailer, "SENDGRID_API_URL", f"http://127.0.0.1:{server.server_address[1]}/v3/mail/send")
+    monkeypatch.setattr(mailer, "SENDGRID_API_KEY", "test-key")
+    monkeypatch.setattr(mailer, "SEND_TIMEOUT", 0.2)
+    monkeypatch.setattr(mailer, "_session", None)
+    sleeps = []
+    monkeypatch.setattr(mailer.time, "sleep", sleeps.append)
+    yield SendGridStub.calls, sleeps
+    server.shutdown(); server.server_close()
+
+def test_send_failures_are_retried_then_reported_per_recipient(sendgrid, monkeypatch):
+    calls, sleeps = sendgrid
+    st = SqliteStorage(":memory:")
+    for e in ("ok@x", "slow@x", "down@x"): st.add_allowed(e)
+    monkeypatch.setattr(web, "fetch_mailbox", lambda st, mailbox, build, days=1: [{"id": "1", "subject": "hello", "ts": 0}])
+    result = web.run_digest(st, {}, lambda **kw: None)
+    attempts = mailer.SEND_RETRIES + 1
+    assert sorted(calls) == sorted(["ok@x"] + ["slow@x"] * attempts + ["down@x"] * attempts)
+    assert sorted(sleeps) == sorted([0.5 * 2 ** i for i in range(mailer.SEND_RETRIES)] * 2)
+    assert result["emailed"] == 1
+    failed = {f["email"]: f["error"] for f in result["failed"]}
+    assert set(failed) == {"slow@x", "down@x"}
+    assert "503" in failed["down@x"] and "timed out" in failed["slow@x"].lower()
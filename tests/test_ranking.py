@@ -0,0 +1,82 @@
+import random
+import pytest
+import ranking
+from matcher import MultiMatcher, AUTOMATON_MIN_KEYWORDS
+from ranking import rank_messages, DEFAULT_WEIGHTS, URGENT_TERMS, MONEY_TERMS
+
+NOW = 1_800_000_000.0
+WORDS = ["invoice", "Urgent", "lunch", "ship", "order", "paid", "boss", "news", "re", "asap", "due", "x"]
+
+@pytest.fixture(autouse=True)
+def fixed_clock(monkeypatch):
+    monkeypatch.setattr(ranking.time, "time", lambda: NOW)
+
+def keywords(rng, n):
+    return ["".join(rng.choice(WORDS) for _ in range(rng.randint(1, 2))) for _ in range(n)]
+
+def texts(rng, n=200):
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 8))).lower() for _ in range(n)]
+
+def brute_force(categories, text):
+    return sum(1 << i for i, kws in enumerate(categories) if any(k.lower() in text for k in kws))
+
+@pytest.mark.parametrize("size", [3, AUTOMATON_MIN_KEYWORDS + 10])
+@pytest.mark.parametrize("extra", [[], [""], ["MiXeD", "uRgEnT"]])
+def test_matcher_agrees_with_brute_force(size, extra):
+    rng = random.Random(size)
+    categories = [keywords(rng, size // 3) + extra, [], keywords(rng, size - size // 3), extra]
+    m = MultiMatcher(categories)
+    assert (m.automaton is not None) == (len({k.lower() for kws in categories for k in kws if k}) >= AUTOMATON_MIN_KEYWORDS)
+    for text in texts(rng) + ["", "mixed urgent"]:
+        assert m.match(text) == brute_force(categories, text), text
+
+def baseline_score(msg, prefs):
+    """The original per-message scorer: one `any(k in ...)` scan per rule."""
+    weights = {**DEFAULT_WEIGHTS, **prefs.get("weights", {})}
+    sender = (msg.get("from") or "").lower()
+    text = f"{(msg.get('subject') or '').lower()} {(msg.get('snippet') or '').lower()}"
+    rules = [(sender, "vip_senders", "vip", "VIP"), (sender, "blocked_senders", "blocked", "Blocked sender"),
+             (text, "always_keywords", "always_kw", "Always-show keyword"), (text, "mute_keywords", "mute_kw", "Muted keyword")]
+    score, reasons = 0.0, []
+    for field, key, weight, reason in rules:
+        if any(k.lower() in field for k in prefs.get(key, [])):
+            score += weights[weight]; reasons.append(reason)
+    for terms, weight, reason in ((URGENT_TERMS, "urgent_kw", "Deadline/Urgent"), (MONEY_TERMS, "money_kw", "Billing/Invoice")):
+        if any(k in text for k in terms):
+            score += weights[weight]; reasons.append(reason)
+    score += max(0.0, (NOW - msg["ts"]) / 3600.0) * weights["recency_decay_per_hour"]
+    score += float(prefs.get("urgency_bias", 0.5)) * 0.5
+    return round(score, 3), reasons
+
+def mailbox(rng, n=150):
+    return [{"id": str(i), "from": f"{rng.choice(WORDS)} <{rng.choice(WORDS)}@corp.example>".lower(),
+             "subject": " ".join(rng.choice(WORDS) for _ in range(3)), "snippet": " ".join(rng.choice(WORDS) for _ in range(6)),
+             "ts": NOW - rng.randint(0, 72) * 3600} for i in range(n)]
+
+@pytest.mark.parametrize("size", [2, AUTOMATON_MIN_KEYWORDS])
+def test_rank_messages_matches_the_baseline_scorer(size):
+    rng = random.Random(size)
+    prefs = {"vip_senders": ["BOSS@"], "blocked_senders": ["news"], "always_keywords": keywords(rng, size) + ["Lunch"],
+             "mute_keywords": keywords(rng, size), "urgency_bias": 0.3, "weights": {"mute_kw": -1.5}}
+    msgs = mailbox(rng)
+    ranked = rank_messages(msgs, prefs)
+    assert sorted(m["id"] for m in ranked) == sorted(m["id"] for m in msgs)
+    for m in ranked:
+        assert (m["score"], m["reasons"]) == baseline_score(m, prefs), m["id"]
+    assert [m["score"] for m in ranked] == sorted((m["score"] for m in ranked), reverse=True)
+    assert rank_messages(iter(msgs), prefs, top_n=10) == ranked[:10]
+
+def test_batch_ranking_matches_rank_messages_per_user():
+    rng = random.Random(7)
+    msgs = mailbox(rng, 120)
+    for m in msgs[:40]: m["ts"] = NOW - 3600  # many identical scores, so ties straddle every cut
+    prefs_by_user = {
+        "a@x": {},
+        "b@x": {"vip_senders": ["boss"], "mute_keywords": ["lunch", ""], "weights": {"vip": 9}},
+        "c@x": {"always_keywords": keywords(rng, AUTOMATON_MIN_KEYWORDS), "blocked_senders": ["NEWS"], "urgency_bias": 0.9},
+        "d@x": {"always_keywords": ["Order"], "mute_keywords": ["ship"], "weights": {"recency_decay_per_hour": 0}},
+    }
+    for top_n in (None, 1, 5, 17, 119, 500):
+        batch = ranking.rank_messages_for_users(msgs, prefs_by_user, top_n=top_n)
+        for email, prefs in prefs_by_user.items():
+            assert batch[email] == rank_messages(msgs, prefs, top_n=top_n), (email, top_n)
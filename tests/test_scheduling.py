@@ -0,0 +1,79 @@
+import pytest
+import app as web
+from sqlite_storage import SqliteStorage
+
+@pytest.fixture
+def st(monkeypatch):
+    st = SqliteStorage(":memory:")
+    monkeypatch.setattr(web, "get_storage", lambda: st)
+    monkeypatch.setattr(web, "fetch_mailbox", lambda st, mailbox, build, days=1: [])
+    return st
+
+def run(st, monkeypatch, params):
+    sent = []
+    monkeypatch.setattr(web, "deliver_digest", lambda st, email, mailbox, ranked, prefs: sent.append(email))
+    return web.run_digest(st, params, lambda **kw: None), sent
+
+def test_shards_partition_the_allowlist(st, monkeypatch):
+    emails = [f"u{i}@x" for i in range(40)]
+    for e in emails: st.add_allowed(e)
+    seen = []
+    for shard in range(4):
+        _, sent = run(st, monkeypatch, {"shard": shard, "of": 4})
+        assert all(web.shard_of(e, 4) == shard for e in sent)
+        seen += sent
+    assert sorted(seen) == sorted(emails)
+
+@pytest.mark.parametrize("bad", [["5pm"], None, "5", [24], [True]])
+def test_invalid_delivery_hours_do_not_fail_the_shard(st, monkeypatch, bad):
+    for e in ("a@x", "b@x", "c@x"): st.add_allowed(e)
+    st.save_prefs("a@x", {"delivery_hours": bad})
+    st.save_prefs("b@x", {"delivery_hours": [7]})
+    result, sent = run(st, monkeypatch, {"hour": 5})
+    assert sorted(sent) == ["a@x", "c@x"] and result["failed"] == []  # a@x falls back to the default hours
+    _, sent = run(st, monkeypatch, {"hour": 7})
+    assert sent == ["b@x"]
+
+@pytest.mark.parametrize("hours, status", [([5, 17], 200), (["5pm"], 400), (None, 400), ([24], 400)])
+def test_prefs_endpoint_validates_delivery_hours(st, monkeypatch, hours, status):
+    class User: email = "a@x"
+    monkeypatch.setattr(web, "current_user", User())
+    monkeypatch.setitem(web.app.config, "LOGIN_DISABLED", True)
+    r = web.app.test_client().post("/api/prefs", json={"delivery_hours": hours}, base_url="https://localhost")
+    assert r.status_code == status
+    assert st.get_prefs("a@x").get("delivery_hours") == (hours if status == 200 else [5, 12, 16])
+
+def test_revoked_grant_falls_back_to_the_shared_mailbox(monkeypatch):
+    import tokens
+    from cryptography.fernet import Fernet
+    monkeypatch.setattr(tokens, "TOKEN_ENCRYPTION_KEYS", [Fernet.generate_key().decode()])
+    monkeypatch.setattr(tokens, "_fernet", None)
+    st = SqliteStorage(":memory:")
+    st.save_gmail_token("a@x", "refresh-1")
+    def revoked(): raise web.RefreshError("invalid_grant: Token has been expired or revoked.")
+    monkeypatch.setattr(web, "_fetch_mailbox", lambda st, mailbox, build, days: (build(), [{"id": mailbox}])[1])
+    monkeypatch.setattr(web, "build_gmail_service", lambda: None)
+    assert web.fetch_mailbox(st, "a@x", revoked) == [{"id": "me"}]
+    assert st.get_gmail_token("a@x") is None
+    with pytest.raises(web.RefreshError):
+        web.fetch_mailbox(st, "me", revoked)
+
+def test_a_failed_mailbox_lookup_only_fails_that_user(st, monkeypatch):
+    for e in ("a@x", "b@x"): st.add_allowed(e)
+    real = st.get_gmail_token
+    def token(email):
+        if email == "a@x": raise RuntimeError("throttled")
+        return real(email)
+    monkeypatch.setattr(st, "get_gmail_token", token)
+    result, sent = run(st, monkeypatch, {})
+    assert sent == ["b@x"] and [f["email"] for f in result["failed"]] == ["a@x"]
+
+@pytest.mark.parametrize("days, fetched, status", [("7", 7, 200), ("365", 30, 200), ("0", 1, 200), ("-5", 1, 200), ("week", None, 400)])
+def test_digest_window_is_clamped(st, monkeypatch, days, fetched, status):
+    class User: email = "a@x"
+    seen = []
+    monkeypatch.setattr(web, "current_user", User())
+    monkeypatch.setitem(web.app.config, "LOGIN_DISABLED", True)
+    monkeypatch.setattr(web, "fetch_mailbox", lambda st, mailbox, build, days=1: seen.append(days) or [])
+    r = web.app.test_client().get(f"/api/digest?days={days}", base_url="https://localhost")
+    assert r.status_code == status and seen == ([fetched] if fetched else [])
@@ -0,0 +1,155 @@
+"""Behaviour every Storage backend must share; each test runs against SQLite
+(in memory and on disk) and, when configured, Cosmos DB."""
+import threading
+from datetime import datetime
+import pytest
+from azure.cosmos import exceptions
+from ranking import REASON_BITS
+
+REASON = next(iter(REASON_BITS))
+
+def messages(n=5):
+    return [{"id": str(i), "threadId": f"t{i}", "subject": f"s{i}", "score": float(i), "reasons": [REASON]} for i in range(n)]
+
+def test_allowlist_and_admin(st):
+    st.bootstrap_admin("a@x"); st.add_allowed("b@x")
+    assert st.is_admin("a@x") and not st.is_admin("b@x")
+    assert st.is_allowed("b@x") and sorted(st.get_allowlist()) == ["a@x", "b@x"]
+    st.remove_allowed("b@x")
+    assert not st.is_allowed("b@x") and st.get_allowlist() == ["a@x"]
+
+def test_prefs_roundtrip(st):
+    assert st.get_prefs("a@x")["top_n"] == 20
+    st.save_prefs("a@x", {"top_n": 3})
+    assert st.get_prefs("a@x") == {"top_n": 3}
+
+def test_sync_state(st):
+    assert st.get_sync_state("me", 1) is None
+    st.save_sync_state("me", 1, "42", [{"id": "1"}])
+    state = st.get_sync_state("me", 1)
+    assert state["history_id"] == "42" and state["messages"] == [{"id": "1"}]
+
+def test_jobs_are_created_once_and_updated_optimistically(st):
+    job, created = st.create_job("r1", {"shard": 1})
+    assert created and job["status"] == "queued"
+    again, created = st.create_job("r1", {})
+    assert not created and again["params"] == {"shard": 1}
+    running = st.update_job(job, status="running")
+    assert running["status"] == "running"
+    assert st.update_job(job, status="stale") is None  # etag moved on
+    assert st.get_job("r1")["status"] == "running" and st.get_job("missing") is None
+
+def test_digest_pages_newest_first(st):
+    for _ in range(3): st.save_digest("a@x", messages())
+    page, token = st.get_digest_page("a@x", 2)
+    assert len(page) == 2 and token
+    rest, token = st.get_digest_page("a@x", 2, token)
+    assert len(rest) == 1 and token is None
+    assert page[0]["created_at"] >= page[1]["created_at"] >= rest[0]["created_at"]
+    assert [m["subject"] for m in page[0]["data"]] == [f"s{i}" for i in range(5)]
+    assert page[0]["data"][0]["reasons"] == [REASON]
+    assert st.get_digest_page("b@x", 2) == ([], None)
+
+def test_digests_since_and_rollups(st):
+    for _ in range(3): st.save_digest("a@x", messages())
+    assert len(st.get_digests_since("2000")) == 3
+    day = datetime.utcnow().date().isoformat()
+    rollup = st.get_rollups(day, day)
+    assert rollup[0]["digests"] == 3 and rollup[0]["messages"] == 15
+
+def test_latest_digest(st):
+    assert st.get_latest("a@x") is None
+    st.save_latest("a@x", {"version": "v1", "ranked": messages(2)})
+    assert st.get_latest("a@x")["version"] == "v1"
+
+def test_migration_and_retention(st):
+    st.save_digest("a@x", messages())
+    st.container.upsert_item({"id": "digest:old", "pk": "digest", "email": "c@x", "created_at": "2001-01-01", "data": []})
+    assert st.migrate_digest_partitions() == 1 and st.migrate_digest_partitions() == 0
+    assert "digest:c@x" in st._digest_partitions()
+    result = st.cleanup_retention(days=30, ru_per_second=1e9)
+    assert result["digest"]["deleted"] == 1
+    assert len(st.get_digests_since("2000")) == 1
+
+def test_missing_items_raise_cosmos_errors(st):
+    with pytest.raises(exceptions.CosmosResourceNotFoundError):
+        st.container.read_item("nope", partition_key="x")
+
+def test_concurrent_writers(st):
+    def write(n):
+        for _ in range(10): st.save_digest(f"u{n}@x", messages())
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(st.get_digests_since("2000")) == 40
+
+def test_message_ids_are_scoped_to_their_mailbox(st):
+    # Gmail ids are only unique per mailbox; one user's metadata must not leak into another's history.
+    st.save_digest("a@x", [{"id": "1", "subject": "for a", "score": 1.0, "reasons": []}], mailbox="a@x")
+    st.save_digest("b@x", [{"id": "1", "subject": "for b", "score": 1.0, "reasons": []}], mailbox="b@x")
+    assert st.get_digest_page("a@x", 1)[0][0]["data"][0]["subject"] == "for a"
+    assert st.get_digest_page("b@x", 1)[0][0]["data"][0]["subject"] == "for b"
+
+def test_digests_saved_before_mailbox_scoping_still_expand(st):
+    st.container.upsert_item({"id": "msg:7", "pk": "msg", "last_seen": "2099-01-01", "m": {"id": "7", "subject": "legacy"}})
+    st.container.upsert_item({"id": "digest:a@x:2099-01-01", "pk": "digest:a@x", "email": "a@x", "created_at": "2099-01-01", "v": 2, "items": [["7", 1.0, 0]]})
+    assert st.get_digest_page("a@x", 1)[0][0]["data"][0]["subject"] == "legacy"
+
+def test_gmail_tokens_are_encrypted_and_unreadable_without_the_key(st, monkeypatch):
+    import tokens
+    from cryptography.fernet import Fernet
+    monkeypatch.setattr(tokens, "TOKEN_ENCRYPTION_KEYS", [Fernet.generate_key().decode()])
+    monkeypatch.setattr(tokens, "_fernet", None)
+    st.save_gmail_token("a@x", "refresh-1")
+    assert "refresh-1" not in str(st.container.read_item("token:a@x", partition_key="token"))
+    assert st.get_gmail_token("a@x") == "refresh-1"
+    monkeypatch.setattr(tokens, "TOKEN_ENCRYPTION_KEYS", [])
+    monkeypatch.setattr(tokens, "_fernet", None)
+    st.token_cache.invalidate("a@x")  # as after the restart that drops the key
+    assert st.get_gmail_token("a@x") is None  # key removed: fall back to the shared mailbox, don't raise
+    st.delete_gmail_token("a@x")
+    assert st.get_gmail_token("b@x") is None
+
+@pytest.mark.parametrize("token", ["not json", "[1, 2]", "{}"])
+def test_malformed_continuation_raises_value_error(st, token):
+    st.save_digest("a@x", messages())
+    with pytest.raises(ValueError):
+        st.get_digest_page("a@x", 1, token)
+
+def test_gmail_token_reads_are_cached_and_transient_errors_raise(st, monkeypatch):
+    import tokens
+    from cryptography.fernet import Fernet
+    monkeypatch.setattr(tokens, "TOKEN_ENCRYPTION_KEYS", [Fernet.generate_key().decode()])
+    monkeypatch.setattr(tokens, "_fernet", None)
+    st.save_gmail_token("a@x", "refresh-1")
+    assert st.get_gmail_token("a@x") == "refresh-1"
+    def throttled(*args, **kwargs): raise exceptions.CosmosHttpResponseError(status_code=429, message="throttled")
+    with monkeypatch.context() as m:
+        m.setattr(st.container, "read_item", throttled)
+        assert st.get_gmail_token("a@x") == "refresh-1"  # served from the cache
+        with pytest.raises(exceptions.CosmosHttpResponseError):
+            st.get_gmail_token("b@x")  # not "no token": that would silently switch b@x to the shared mailbox
+    st.save_gmail_token("a@x", "refresh-2")
+    assert st.get_gmail_token("a@x") == "refresh-2"
+
+def test_messages_are_partitioned_and_swept_per_mailbox(st):
+    st.save_digest("a@x", messages(2), mailbox="a@x")
+    st.save_digest("b@x", messages(3), mailbox="me")
+    assert st.container.read_item("msg:a@x:1", partition_key="msg:a@x")["m"]["subject"] == "s1"
+    assert set(st._message_partitions()) == {"msg:a@x", "msg:me"}
+    # Written before partitioning: the mailbox-scoped id in the old shared partition.
+    st.container.upsert_item({"id": "msg:c@x:9", "pk": "msg", "last_seen": "2099-01-01", "m": {"id": "9", "subject": "old"}})
+    st.container.upsert_item({"id": "digest:c@x:2099-01-01", "pk": "digest:c@x", "email": "c@x", "mailbox": "c@x", "created_at": "2099-01-01", "v": 2, "items": [["9", 1.0, 0]]})
+    assert st.get_digest_page("c@x", 1)[0][0]["data"][0]["subject"] == "old"
+    for pk, i in (("msg:a@x", "msg:a@x:0"), ("msg:me", "msg:me:0"), ("msg", "msg:c@x:1")):
+        st.container.upsert_item({"id": i, "pk": pk, "last_seen": "2001-01-01", "m": {"id": i[-1]}})
+    assert st.cleanup_retention(days=30, ru_per_second=1e9)["msg"]["deleted"] == 3
+    assert [m["id"] for m in st.get_digest_page("a@x", 1)[0][0]["data"]] == ["1"]
+
+def test_incomplete_backends_fail_at_construction():
+    from storage import Storage
+    from sqlite_storage import SqliteStorage
+    hooks = {k: getattr(SqliteStorage, k) for k in Storage.__abstractmethods__ if k != "get_rollups"}
+    Incomplete = type("Incomplete", (Storage,), hooks)
+    with pytest.raises(TypeError, match="get_rollups"):
+        Incomplete(None)
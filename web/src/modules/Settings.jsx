@@ -133,6 +133,14 @@ export function Settings(){
           </div>
         </div>
 
+        <div>
+          <label className='block font-semibold mb-1'>Delivery hours (0–23, comma-separated)</label>
+          <input className='border rounded-lg p-1 w-48' defaultValue={(prefs.delivery_hours||[5,12,16]).join(', ')} onBlur={e=>{
+            const hours = Array.from(new Set(e.target.value.split(',').map(h=>parseInt(h,10)).filter(h=>h>=0 && h<24))).sort((a,b)=>a-b)
+            setPrefs({...prefs, delivery_hours: hours})
+          }} />
+        </div>
+
         <div className='flex justify-between'>
           <button className='px-4 py-2 rounded-xl border' onClick={save}>Save</button>
           <button className='px-4 py-2 rounded-xl border' onClick={preview}>Preview emailed digest</button>